@@ -0,0 +1,172 @@
+"""Compare the allocations and the speed of the stock UDP client,
+`statsd.StatsClient`, and of the buffered one,
+`nameko_statsd.transport.BufferedStatsClient`, used through
+`nameko_statsd.statsd_dep.LazyClient` like the workers of a service do:
+
+- `worker`: two stats sent by a new `LazyClient`, like the one
+  `StatsD.get_dependency` gives to each worker,
+- `single`: three stats sent on their own by a `LazyClient`,
+- `pipeline`: a hundred stats sent through a `pipeline` of a `LazyClient`.
+
+The allocations are counted exactly, transient ones included: the
+measurement runs in a subprocess using the system allocator
+(`PYTHONMALLOC=malloc`) and the glibc malloc tracer (`mtrace`, preloaded
+from `libc_malloc_debug.so`), which logs every `malloc` made between
+`mtrace()` and `muntrace()`.  Without glibc, only the speed is measured.
+
+The packets are sent to a local UDP socket, which never reads them.
+
+    python benchmarks/transport.py
+"""
+import ctypes
+import ctypes.util
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from nameko_statsd.settings import SharedSettings
+from nameko_statsd.statsd_dep import LazyClient
+
+
+# client name: whether it is the buffered one
+CLIENTS = {'StatsClient': False, 'BufferedStatsClient': True}
+
+# the packets are dropped once its receive buffer is full
+SINK = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+SINK.bind(('127.0.0.1', 0))
+
+
+def settings(name):
+    """Return the settings shared by the workers using the `name` client. """
+    return SharedSettings.from_config({
+        'enabled': True,
+        'host': '127.0.0.1',
+        'port': SINK.getsockname()[1],
+        'prefix': 'service.prefix',
+        'buffered': CLIENTS[name],
+    })
+
+
+def worker(settings):
+    client = LazyClient(settings=settings)
+    client.incr('requests.count')
+    client.timing('requests.time', 12.345)
+
+
+def single(client):
+    client.incr('requests.count')
+    client.gauge('queue.size', 42)
+    client.timing('requests.time', 12.345)
+
+
+def pipelined(client):
+    with client.pipeline() as pipe:
+        for index in range(50):
+            pipe.incr('requests.count')
+            pipe.timing('requests.time', index * 0.5)
+
+
+SCENARIOS = {
+    # name: (setup, function, metrics emitted by each call), `setup` being
+    # given the settings and returning the argument of `function`
+    'worker': (lambda settings: settings, worker, 2),
+    'single': (LazyClient, single, 3),
+    'pipeline': (LazyClient, pipelined, 100),
+}
+
+
+def target(scenario, name):
+    """Return the function of the scenario and its argument. """
+    setup, function, _ = SCENARIOS[scenario]
+    return function, setup(settings(name))
+
+
+# the symbol versions of `mtrace` on x86_64 and aarch64
+VERSIONS = (b'GLIBC_2.2.5', b'GLIBC_2.17')
+
+
+def tracer(library):
+    """Return the `mtrace` and `muntrace` functions of the glibc malloc
+    debugging library.
+
+    They are only exported with a symbol version, `dlsym` finds the no-op
+    stubs of libc instead.
+    """
+    dlvsym = ctypes.CDLL(None).dlvsym
+    dlvsym.restype = ctypes.c_void_p
+    dlvsym.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+    handle = ctypes.CDLL(library)._handle
+
+    for version in VERSIONS:
+        start = dlvsym(handle, b'mtrace', version)
+        if start:
+            stop = dlvsym(handle, b'muntrace', version)
+            function = ctypes.CFUNCTYPE(None)
+            return function(start), function(stop)
+    raise RuntimeError('mtrace not found in {}'.format(library))
+
+
+def count_allocations(library, scenario, name, repeat=1000):
+    """Print the number of `malloc` calls made by `repeat` calls of the
+    scenario, run in the subprocess set up by `allocations`.
+    """
+    function, each = target(scenario, name)
+    for _ in range(10):
+        function(each)  # warm up the caches and the free lists
+
+    start, stop = tracer(library)
+    calls = [None] * repeat  # the loop itself allocates nothing
+    start()
+    for _ in calls:
+        function(each)
+    stop()
+
+    with open(os.environ['MALLOC_TRACE']) as trace:
+        mallocs = sum(1 for line in trace if ' + ' in line)
+    print(mallocs / repeat)
+
+
+def allocations(scenario, name):
+    """Return the mean number of allocations of a call of the scenario, or
+    `None` when they cannot be traced.
+    """
+    library = ctypes.util.find_library('c_malloc_debug')
+    if library is None:
+        return None
+
+    with tempfile.NamedTemporaryFile(suffix='.mtrace') as trace:
+        env = dict(
+            os.environ, PYTHONMALLOC='malloc', LD_PRELOAD=library,
+            MALLOC_TRACE=trace.name,
+        )
+        output = subprocess.check_output(
+            [sys.executable, __file__, library, scenario, name], env=env,
+        )
+    return float(output)
+
+
+def main():
+    for scenario, (_, _, metrics) in SCENARIOS.items():
+        print('{} ({} metrics per call)'.format(scenario, metrics))
+        for name in CLIENTS:
+            function, each = target(scenario, name)
+            seconds = min(timeit.repeat(
+                lambda: function(each), number=1000, repeat=5
+            ))
+            mallocs = allocations(scenario, name)
+            print('  {:<20} {:>6.2f} us/metric {:>6} mallocs/metric'.format(
+                name, seconds * 1e6 / 1000 / metrics,
+                'n/a' if mallocs is None else '{:.2f}'.format(
+                    mallocs / metrics
+                ),
+            ))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4:
+        count_allocations(*sys.argv[1:])
+    else:
+        main()
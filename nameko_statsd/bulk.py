@@ -0,0 +1,141 @@
+"""Client side aggregation for the bulk emission methods of `LazyClient`.
+
+NumPy is used, when installed, to aggregate the values in a vectorized way.
+"""
+from .percentiles import percentile, rank
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+def group(stats, values, dtype=None):
+    """Group `values` by stat name.
+
+    Args:
+        stats (str or iterable): Either a single stat name for all the
+            values, or one stat name per value.
+        values (iterable): The values.
+        dtype: The NumPy data type of the values, inferred if `None`.
+
+    Returns:
+        A list of `(name, values)` pairs sorted by name, where `values` is a
+        NumPy array if NumPy is installed or a list otherwise.
+
+    Raises:
+        ValueError: If there is not one stat name per value.
+    """
+    if numpy is not None:
+        values = numpy.asarray(_sequence(values), dtype=dtype)
+    else:
+        values = _list(values)
+
+    if isinstance(stats, str):
+        return [(stats, values)]
+
+    stats = _sequence(stats)
+    if len(stats) != len(values):
+        raise ValueError(
+            'Got {} stat names for {} values'.format(len(stats), len(values))
+        )
+
+    if numpy is not None:
+        names, inverse = numpy.unique(
+            numpy.asarray(stats), return_inverse=True
+        )
+        inverse = inverse.ravel()
+        bounds = numpy.cumsum(numpy.bincount(inverse))[:-1]
+        groups = numpy.split(
+            values[numpy.argsort(inverse, kind='stable')], bounds
+        )
+        return list(zip(names.tolist(), groups))
+
+    groups = {}
+    for name, value in zip(_list(stats), values):
+        groups.setdefault(name, []).append(value)
+    return sorted(groups.items())
+
+
+def sums(stats, values):
+    """Return the `(name, total)` pairs of `values` summed by stat name. """
+    if numpy is not None:
+        return [
+            (name, group_values.sum().item())
+            for name, group_values in group(stats, values)
+        ]
+
+    return [
+        (name, sum(group_values))
+        for name, group_values in group(stats, values)
+    ]
+
+
+def samples(stats, values):
+    """Return the `(name, values)` pairs of `values` grouped by stat name, as
+    lists of Python numbers.
+    """
+    return [
+        (name, _list(group_values))
+        for name, group_values in group(stats, values, dtype=float)
+    ]
+
+
+def lasts(stats, values):
+    """Return the `(name, value)` pairs of the last value of each stat. """
+    return [
+        (name, _item(group_values[-1]))
+        for name, group_values in group(stats, values) if len(group_values)
+    ]
+
+
+def summaries(stats, values, percentiles):
+    """Return the `(name, summary)` pairs of the statistics of `values` by
+    stat name.
+
+    `summary` is a list of `(suffix, value)` pairs with the `count`, `mean`,
+    `min`, `max` and `p<N>` percentile (nearest rank) of the values.
+    """
+    result = []
+
+    for name, group_values in group(stats, values, dtype=float):
+        count = len(group_values)
+        if not count:
+            continue
+
+        if numpy is not None:
+            ordered = numpy.sort(group_values)
+            ranks = [rank(count, pct) for pct in percentiles]
+            mean = ordered.mean().item()
+            points = ordered[ranks].tolist()
+            ordered = ordered[[0, -1]].tolist()
+        else:
+            ordered = sorted(group_values)
+            mean = sum(ordered) / float(count)
+            points = [percentile(ordered, pct) for pct in percentiles]
+
+        summary = [
+            ('count', count),
+            ('mean', mean),
+            ('min', ordered[0]),
+            ('max', ordered[-1]),
+        ]
+        summary.extend(
+            ('p{}'.format(pct), point)
+            for pct, point in zip(percentiles, points)
+        )
+        result.append((name, summary))
+
+    return result
+
+
+def _sequence(values):
+    return values if hasattr(values, '__len__') else list(values)
+
+
+def _list(values):
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
+
+
+def _item(value):
+    return value.item() if hasattr(value, 'item') else value
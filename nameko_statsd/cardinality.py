@@ -0,0 +1,76 @@
+import eventlet
+
+
+class CardinalityGuard(object):
+
+    """Limit the number of distinct stat names sent.
+
+    The first `limit` distinct names seen are admitted.  Any other name is
+    refused, so that it can be collapsed into the `bucket` stat.  Admitted
+    names are kept in a set, so memory is bounded by `limit` and checking an
+    already admitted name is a single set lookup.
+
+    Refusals are only counted when they happen: every `interval` seconds,
+    the `stat` counter is incremented by the number of refusals since the
+    previous report, so that a flood of new names does not also send one
+    packet per refusal.
+    """
+
+    def __init__(
+        self, client, limit=1000, bucket='cardinality.other',
+        stat='cardinality.overflow', interval=10,
+    ):
+        """
+        Args:
+            client (LazyClient): The client used to send the `stat` counter.
+            limit (int): The maximum number of distinct stat names.
+            bucket (str): The name refused stats are sent as.
+            stat (str): The counter of refused stats.
+            interval (float): Seconds between two reports of the counter.
+        """
+        self.client = client
+        self.limit = limit
+        self.bucket = bucket
+        self.stat = stat
+        self.interval = interval
+        self.names = set()
+        self.overflows = 0
+        self._reported = 0
+        self._running = False
+
+    def admit(self, name):
+        """Return whether the stat `name` can be sent as is. """
+        names = self.names
+        if name in names:
+            return True
+
+        if len(names) < self.limit:
+            names.add(name)
+            return True
+
+        self.overflows += 1
+        return False
+
+    def run(self):
+        """Report the refusals until `stop` is called.
+
+        Meant to be run in its own greenthread.
+        """
+        self._running = True
+
+        try:
+            while self._running:
+                eventlet.sleep(self.interval)
+                self.report()
+        finally:
+            self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def report(self):
+        overflows = self.overflows
+        count, self._reported = overflows - self._reported, overflows
+
+        if count:
+            self.client.incr(self.stat, count)
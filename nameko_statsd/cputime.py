@@ -0,0 +1,150 @@
+"""CPU time accounting per greenthread.
+
+All the greenthreads of a hub share one OS thread, so the CPU time of the
+thread is split between them with a `greenlet` trace function, which
+attributes the time elapsed since the previous switch to the greenlet that
+was running.
+
+The trace function runs on every greenlet switch of the process: it reads
+the thread CPU clock (a system call) and updates a dictionary, which adds 1
+to 2 microseconds to each switch.  It is only installed while a `StatsD`
+dependency provider using `dual_timer` is running.
+"""
+from weakref import WeakKeyDictionary
+
+import greenlet
+from eventlet import patcher
+
+try:
+    from time import perf_counter_ns, thread_time_ns
+except ImportError:  # pragma: no cover (Python 3.6)
+    from time import CLOCK_THREAD_CPUTIME_ID, clock_gettime, perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1e9)
+
+    def thread_time_ns():
+        return int(clock_gettime(CLOCK_THREAD_CPUTIME_ID) * 1e9)
+
+
+_get_ident = patcher.original('threading').get_ident
+
+
+class GreenletCpuClock(object):
+
+    """Measure the CPU time consumed by each greenlet of an OS thread. """
+
+    def __init__(self):
+        self.thread_id = None
+        self._times = WeakKeyDictionary()
+        self._last = None
+        self._previous_trace = None
+        self._users = 0
+
+    def install(self):
+        """Start accounting the greenlets of the calling OS thread. """
+        self.thread_id = _get_ident()
+        self._last = thread_time_ns()
+        self._previous_trace = greenlet.settrace(self._trace)
+
+    def uninstall(self):
+        greenlet.settrace(self._previous_trace)
+        self.thread_id = None
+        self._times.clear()
+
+    def acquire(self):
+        """Install the clock in the calling OS thread, unless it already is.
+
+        Each call must be matched by a call to `release`.
+        """
+        if not self._users:
+            self.install()
+        self._users += 1
+
+    def release(self):
+        """Uninstall the clock once every `acquire` has been released. """
+        self._users -= 1
+        if not self._users:
+            self.uninstall()
+
+    def cpu_time_ns(self):
+        """Return the CPU time consumed by the current greenlet so far, in
+        nanoseconds.
+
+        Outside of the OS thread the clock is installed in, or if it is not
+        installed, return the CPU time consumed by the current OS thread
+        instead.
+        """
+        now = thread_time_ns()
+        if _get_ident() != self.thread_id:
+            return now
+
+        current = greenlet.getcurrent()
+        return self._times.get(current, 0) + now - self._last
+
+    def _trace(self, event, args):
+        # both "switch" and "throw" events give the `(origin, target)` pair
+        origin = args[0]
+        now = thread_time_ns()
+        self._times[origin] = self._times.get(origin, 0) + now - self._last
+        self._last = now
+
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+
+clock = GreenletCpuClock()
+
+
+def cpu_time_ns():
+    """Return the CPU time consumed by the current greenlet, in nanoseconds.
+
+    See `GreenletCpuClock.cpu_time_ns`, only the differences between two
+    calls are meaningful.
+    """
+    return clock.cpu_time_ns()
+
+
+class DualTimer(object):
+
+    """Context manager sending both the wall time and the CPU time of its
+    block, as the `<stat>.wall` and `<stat>.cpu` timings (in milliseconds).
+
+    The CPU time is the one consumed by the current greenthread only, so the
+    difference between the two is the time spent waiting (on I/O, or for
+    other greenthreads to yield).
+    """
+
+    def __init__(self, client, stat, rate=1):
+        """
+        Args:
+            client (LazyClient): The client used to send the timings.
+            stat (str): The prefix of the timings sent.
+            rate (float): The sample rate.
+        """
+        self.client = client
+        self.stat = stat
+        self.rate = rate
+        self.wall_ms = None
+        self.cpu_ms = None
+
+    def __enter__(self):
+        # the wall clock is read outside of the CPU clock, so that the wall
+        # interval contains the CPU one
+        self._wall_start = perf_counter_ns()
+        self._cpu_start = cpu_time_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        cpu = cpu_time_ns() - self._cpu_start
+        wall = perf_counter_ns() - self._wall_start
+
+        self.wall_ms = wall / 1e6
+        # the CPU clock may be coarser than the wall clock
+        self.cpu_ms = min(cpu, wall) / 1e6
+
+        # sampled together, so that the two timings always come in pairs
+        self.client.timings([
+            ('{}.wall'.format(self.stat), self.wall_ms),
+            ('{}.cpu'.format(self.stat), self.cpu_ms),
+        ], self.rate)
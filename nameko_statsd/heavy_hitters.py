@@ -0,0 +1,216 @@
+import heapq
+import logging
+from itertools import count
+from time import perf_counter
+
+import eventlet
+
+log = logging.getLogger(__name__)
+
+
+class SpaceSaving(object):
+
+    """Weighted Space-Saving sketch of the heaviest keys of a stream.
+
+    At most `capacity` keys are tracked.  When a new key arrives while the
+    sketch is full, it replaces the lightest key and inherits its weight,
+    which is recorded as the error of the new key: a tracked key's weight is
+    overestimated by at most its error.  Any key heavier than
+    `total / capacity` is guaranteed to be tracked.
+
+    The lightest key is found with a min-heap of `(weight, order, key)`
+    entries, pushed on every update, so that `add` is `O(log capacity)`.
+    Outdated entries are skipped when popped, and the heap is rebuilt from
+    the counters when they outnumber the current ones.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+        self._heap = []
+        self._order = count()
+
+    def add(self, key, weight=1):
+        counters = self.counters
+
+        counter = counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(counters) < self.capacity:
+            counter = counters[key] = [weight, 0]
+        else:
+            floor = self._pop_lightest()
+            counter = counters[key] = [floor + weight, floor]
+
+        heap = self._heap
+        heapq.heappush(heap, (counter[0], next(self._order), key))
+        if len(heap) > 2 * self.capacity:
+            self._rebuild()
+
+    def _pop_lightest(self):
+        counters = self.counters
+        heap = self._heap
+
+        while True:
+            weight, _, key = heapq.heappop(heap)
+            counter = counters.get(key)
+            if counter is not None and counter[0] == weight:
+                del counters[key]
+                return weight
+
+    def _rebuild(self):
+        order = self._order
+        self._heap = [
+            (weight, next(order), key)
+            for key, (weight, _) in self.counters.items()
+        ]
+        heapq.heapify(self._heap)
+
+    def top(self, n):
+        """Return the `(key, weight, error)` tuples of the `n` heaviest keys,
+        heaviest first.
+        """
+        ordered = sorted(
+            self.counters.items(), key=lambda item: item[1][0], reverse=True
+        )
+        return [(key, weight, error) for key, (weight, error) in ordered[:n]]
+
+
+class HeavyHitters(object):
+
+    """Track the hottest stat names and timed methods.
+
+    Every stat name sent is counted, and every call of a method decorated
+    with `StatsD.timer` (or `StatsD.dual_timer`) is counted and timed, in
+    separate fixed size `SpaceSaving` sketches.  Every `interval` seconds,
+    the weights of the `top` heaviest keys of each sketch are sent as
+    counters indexed by rank, from `1` (the heaviest) to `top`, then the
+    sketches start over:
+
+    - `<stat>.stats.top<rank>`: the number of stats sent with a name,
+    - `<stat>.calls.top<rank>`: the number of calls of a method,
+    - `<stat>.time.top<rank>`: the time spent in a method, in milliseconds.
+
+    The keys themselves are not part of the stat names, which would add as
+    many new names as the flood of names being tracked: they are logged,
+    and kept in `last_report` until the next report.
+    """
+
+    ORDERS = ('stats', 'calls', 'time')
+
+    def __init__(
+        self, client, capacity=100, top=10, stat='heavy_hitters',
+        interval=60,
+    ):
+        """
+        Args:
+            client (LazyClient): The client used to send the stats.
+            capacity (int): The number of keys tracked by each sketch.
+            top (int): The number of keys reported.
+            stat (str): The prefix of the stats sent.
+            interval (float): Seconds between two reports.
+        """
+        self.client = client
+        self.capacity = capacity
+        self.top_n = top
+        self.stat = stat
+        self.interval = interval
+
+        # the `(key, weight, error)` tuples of the last report, by order
+        self.last_report = {}
+
+        self._reset()
+        self._running = False
+
+    def _reset(self):
+        self.stats = SpaceSaving(self.capacity)
+        self.calls = SpaceSaving(self.capacity)
+        self.time = SpaceSaving(self.capacity)
+
+    def observe_stat(self, name):
+        """Count one stat sent as `name`. """
+        self.stats.add(name)
+
+    def observe_call(self, key, ms):
+        """Count one call of the method `key`, taking `ms` milliseconds. """
+        self.calls.add(key)
+        self.time.add(key, ms)
+
+    def timed(self, key):
+        """Context manager observing a call of `key` with its duration. """
+        return _Timed(self, key)
+
+    def top(self, n=None, by='stats'):
+        """Return the heaviest keys since the last report.
+
+        Args:
+            n (int): The number of keys, defaults to `top`.
+            by (str): `'stats'` (stat names by number of stats sent),
+                `'calls'` or `'time'` (methods by number of calls or time).
+
+        Returns:
+            A list of `(key, weight, error)` tuples, heaviest first.
+        """
+        if by not in self.ORDERS:
+            raise ValueError('Invalid heavy hitters order: {}'.format(by))
+
+        return getattr(self, by).top(self.top_n if n is None else n)
+
+    def run(self):
+        """Report the heavy hitters until `stop` is called.
+
+        Meant to be run in its own greenthread.
+        """
+        self._running = True
+
+        try:
+            while self._running:
+                eventlet.sleep(self.interval)
+                self.report()
+        finally:
+            self._running = False
+
+    def stop(self):
+        self._running = False
+
+    def report(self):
+        sketches = [(by, getattr(self, by)) for by in self.ORDERS]
+        self._reset()
+
+        report = {}
+        names, counts = [], []
+        for by, sketch in sketches:
+            top = report[by] = sketch.top(self.top_n)
+            for rank, (key, weight, _) in enumerate(top, 1):
+                names.append('{}.{}.top{}'.format(self.stat, by, rank))
+                counts.append(int(round(weight)))
+
+            if top:
+                log.info(
+                    'Heavy hitters by %s: %s', by, ', '.join(
+                        '{} ({:g})'.format(key, weight)
+                        for key, weight, _ in top
+                    )
+                )
+
+        self.last_report = report
+
+        # through the bulk method, so that the names are guarded too
+        if names:
+            self.client.incr_many(names, counts)
+
+
+class _Timed(object):
+
+    def __init__(self, heavy_hitters, key):
+        self.heavy_hitters = heavy_hitters
+        self.key = key
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.heavy_hitters.observe_call(
+            self.key, (perf_counter() - self._start) * 1000.0
+        )
@@ -0,0 +1,135 @@
+import logging
+import sys
+import traceback
+from collections import deque
+from time import monotonic
+
+import eventlet
+from eventlet import patcher
+
+from .percentiles import percentile
+
+
+log = logging.getLogger(__name__)
+
+# The watchdog must keep running while the hub is blocked, so it lives in a
+# real OS thread and uses the unpatched primitives.
+_threading = patcher.original('threading')
+
+
+class HubLagMonitor(object):
+
+    """Measure the scheduling lag of the eventlet hub.
+
+    A greenthread repeatedly sleeps for `interval` seconds and records how
+    much later than requested it was woken up.  Every `report_interval`
+    seconds the collected samples are sent as gauges (in milliseconds) named
+    `<stat>.p<N>` for each of the requested percentiles, plus `<stat>.max`.
+
+    While the greenthread is asleep, a watchdog OS thread checks that the hub
+    keeps waking it up.  If the hub is stuck for longer than `threshold`
+    seconds, the watchdog captures the stack that is running in the hub's
+    thread, so that the offending code can be logged once the hub recovers.
+    Each of those events also increments `<stat>.blocked`.
+    """
+
+    def __init__(
+        self, client, stat='hub_lag', interval=0.1, report_interval=10,
+        threshold=0.5, percentiles=(50, 90, 99), max_samples=1000,
+    ):
+        """
+        Args:
+            client (LazyClient): The client used to send the stats.
+            stat (str): The prefix of the stats sent.
+            interval (float): Seconds between two samples.
+            report_interval (float): Seconds between two reports.
+            threshold (float): Lag, in seconds, above which the hub is
+                considered blocked.
+            percentiles (list): The lag percentiles to report.
+            max_samples (int): The maximum number of samples kept between
+                two reports.
+        """
+        self.client = client
+        self.stat = stat
+        self.interval = interval
+        self.report_interval = report_interval
+        self.threshold = threshold
+        self.percentiles = tuple(percentiles)
+        self.samples = deque(maxlen=max_samples)
+
+        self._heartbeat = None
+        self._blocked_stack = None
+        self._hub_thread_id = None
+        self._stopped = _threading.Event()
+
+    def run(self):
+        """Sample the hub lag until `stop` is called.
+
+        Meant to be run in its own greenthread.
+        """
+        self._stopped.clear()
+        self._hub_thread_id = _threading.get_ident()
+        self._heartbeat = monotonic()
+
+        watchdog = _threading.Thread(
+            target=self._watch, name='nameko-statsd-hub-watchdog'
+        )
+        watchdog.daemon = True
+        watchdog.start()
+
+        next_report = self._heartbeat + self.report_interval
+        try:
+            while not self._stopped.is_set():
+                now = self.sample()
+                if now >= next_report:
+                    self.report()
+                    next_report = now + self.report_interval
+        finally:
+            self._stopped.set()
+
+    def stop(self):
+        self._stopped.set()
+
+    def sample(self):
+        start = monotonic()
+        eventlet.sleep(self.interval)
+        now = monotonic()
+
+        self._heartbeat = now
+        stack, self._blocked_stack = self._blocked_stack, None
+
+        lag = max(0.0, now - start - self.interval)
+        self.samples.append(lag)
+
+        if lag > self.threshold:
+            self.client.incr('{}.blocked'.format(self.stat))
+            log.warning(
+                'Eventlet hub blocked for %.3fs.%s', lag,
+                '\n' + stack if stack else ' No stack was captured.'
+            )
+
+        return now
+
+    def report(self):
+        samples = sorted(self.samples)
+        self.samples.clear()
+
+        if not samples:
+            return
+
+        with self.client.pipeline() as pipe:
+            for pct in self.percentiles:
+                pipe.gauge(
+                    '{}.p{}'.format(self.stat, pct),
+                    percentile(samples, pct) * 1000.0
+                )
+            pipe.gauge('{}.max'.format(self.stat), samples[-1] * 1000.0)
+
+    def _watch(self):
+        limit = self.interval + self.threshold
+
+        while not self._stopped.wait(self.threshold / 2.0):
+            heartbeat = self._heartbeat
+            if self._blocked_stack is None and monotonic() - heartbeat > limit:
+                frame = sys._current_frames()[self._hub_thread_id]
+                self._blocked_stack = ''.join(traceback.format_stack(frame))
@@ -0,0 +1,15 @@
+import math
+
+
+def rank(count, pct):
+    """Return the index of the `pct` percentile among `count` sorted values,
+    using the nearest-rank method.
+    """
+    return max(int(math.ceil(pct * count / 100.0)) - 1, 0)
+
+
+def percentile(values, pct):
+    """Return the `pct` percentile of the already sorted `values`, using the
+    nearest-rank method.
+    """
+    return values[rank(len(values), pct)]
@@ -0,0 +1,147 @@
+import gc
+import os
+from time import perf_counter
+
+import eventlet
+
+
+GENERATIONS = len(gc.get_count())
+
+
+def rss():
+    """Return the resident set size of the process in bytes, or `None` where
+    `/proc` is not available.
+    """
+    try:
+        with open('/proc/self/statm') as stream:
+            pages = int(stream.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def open_fds():
+    """Return the number of open file descriptors of the process, or `None`
+    where `/proc` is not available.
+    """
+    try:
+        # listing the directory opens one more descriptor
+        return len(os.listdir('/proc/self/fd')) - 1
+    except (IOError, OSError):
+        return None
+
+
+class RuntimeCollector(object):
+
+    """Periodically collect the process runtime metrics.
+
+    Every `interval` seconds the following stats are sent, prefixed by
+    `stat`, in a single pipeline:
+
+    * `rss` and `fds` gauges: resident memory in bytes and open file
+      descriptors.
+    * `greenthreads.workers` and `greenthreads.managed` gauges: greenthreads
+      run by the service container.
+    * `gc.gen<N>.collections` and `gc.gen<N>.pause` counters: collections of
+      each generation and the time (in milliseconds) spent in them, measured
+      with `gc.callbacks`.
+    * `cpu.user` and `cpu.system` counters: CPU time consumed by the process,
+      in milliseconds.
+    """
+
+    def __init__(self, client, container=None, stat='runtime', interval=10):
+        """
+        Args:
+            client (LazyClient): The client used to send the stats.
+            container (ServiceContainer): The container whose greenthreads
+                are counted.
+            stat (str): The prefix of the stats sent.
+            interval (float): Seconds between two reports.
+        """
+        self.client = client
+        self.container = container
+        self.stat = stat
+        self.interval = interval
+
+        self._running = False
+        self._gc_start = None
+        self._gc_collections = [0] * GENERATIONS
+        self._gc_pause = [0.0] * GENERATIONS
+        self._cpu_times = None
+
+    def run(self):
+        """Report the runtime metrics until `stop` is called.
+
+        Meant to be run in its own greenthread.
+        """
+        self._running = True
+        self._cpu_times = os.times()
+        gc.callbacks.append(self._gc_callback)
+
+        try:
+            while self._running:
+                eventlet.sleep(self.interval)
+                self.report()
+        finally:
+            self._running = False
+            gc.callbacks.remove(self._gc_callback)
+
+    def stop(self):
+        self._running = False
+
+    def report(self):
+        stat = self.stat
+
+        collections, self._gc_collections = (
+            self._gc_collections, [0] * GENERATIONS
+        )
+        pauses, self._gc_pause = self._gc_pause, [0.0] * GENERATIONS
+
+        previous, self._cpu_times = self._cpu_times, os.times()
+
+        with self.client.pipeline() as pipe:
+            memory = rss()
+            if memory is not None:
+                pipe.gauge('{}.rss'.format(stat), memory)
+
+            fds = open_fds()
+            if fds is not None:
+                pipe.gauge('{}.fds'.format(stat), fds)
+
+            if self.container is not None:
+                pipe.gauge(
+                    '{}.greenthreads.workers'.format(stat),
+                    len(self.container._worker_threads)
+                )
+                pipe.gauge(
+                    '{}.greenthreads.managed'.format(stat),
+                    len(self.container._managed_threads)
+                )
+
+            for generation in range(GENERATIONS):
+                pipe.incr(
+                    '{}.gc.gen{}.collections'.format(stat, generation),
+                    collections[generation]
+                )
+                pipe.incr(
+                    '{}.gc.gen{}.pause'.format(stat, generation),
+                    pauses[generation] * 1000.0
+                )
+
+            pipe.incr(
+                '{}.cpu.user'.format(stat),
+                (self._cpu_times.user - previous.user) * 1000.0
+            )
+            pipe.incr(
+                '{}.cpu.system'.format(stat),
+                (self._cpu_times.system - previous.system) * 1000.0
+            )
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = perf_counter()
+        elif self._gc_start is not None:
+            generation = info['generation']
+            self._gc_collections[generation] += 1
+            self._gc_pause[generation] += perf_counter() - self._gc_start
+            self._gc_start = None
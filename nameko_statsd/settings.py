@@ -0,0 +1,206 @@
+from collections import namedtuple
+from enum import Enum
+
+from statsd import StatsClient, TCPStatsClient
+
+from .transport import BufferedStatsClient
+
+# position of the `rate` argument of the `StatsClient` methods, after `stat`
+RATE_POSITIONS = {
+    'incr': 1, 'decr': 1, 'gauge': 1, 'set': 1, 'timing': 1, 'timer': 0,
+}
+
+
+class Protocols(Enum):
+    tcp = 'tcp'
+    udp = 'udp'
+
+
+# the arguments accepted by the statsd client of each protocol
+CLIENT_ARGUMENTS = {
+    Protocols.udp: frozenset(['host', 'port', 'prefix', 'maxudpsize', 'ipv6']),
+    Protocols.tcp: frozenset(['host', 'port', 'prefix', 'timeout', 'ipv6']),
+}
+
+
+def get_protocol(protocol):
+    try:
+        return getattr(Protocols, protocol.lower())
+    except AttributeError:
+        raise ValueError(
+            'Invalid protocol: {}'.format(protocol)
+        )
+
+
+def sort_rates(rates):
+    """Return the `(prefix, rate)` pairs of the `rates` dictionary, longest
+    prefix first.
+    """
+    return tuple(
+        sorted(rates.items(), key=lambda item: len(item[0]), reverse=True)
+    )
+
+
+class Settings(
+    namedtuple(
+        'Settings', ['enabled', 'protocol', 'config', 'rates', 'buffered']
+    )
+):
+
+    """Immutable snapshot of the settings of a client.
+
+    `config` holds the arguments of the statsd client, `rates` the sample
+    rates overriding those given by the caller, as `(prefix, rate)` pairs
+    sorted by `sort_rates`, and `buffered` whether the UDP client assembles
+    its packets in a preallocated buffer.
+    """
+
+    __slots__ = ()
+
+    def rate(self, stat):
+        """Return the sample rate overriding the one of `stat`, if any. """
+        for prefix, rate in self.rates:
+            if stat.startswith(prefix):
+                return rate
+
+    def override_rate(self, name, stat, args, kwargs):
+        """Return the `args` and `kwargs` of a call of the `name` method of
+        `StatsClient` for `stat`, with the `rate` argument replaced by the
+        one configured for the prefix of `stat`, if any.
+        """
+        rate = self.rate(stat)
+        if rate is None:
+            return args, kwargs
+
+        position = RATE_POSITIONS[name]
+        if len(args) > position:
+            args = args[:position] + (rate,) + args[position + 1:]
+        else:
+            kwargs = dict(kwargs, rate=rate)
+
+        return args, kwargs
+
+    @property
+    def shared(self):
+        """Whether a single statsd client is shared by all the clients using
+        these settings: the buffered UDP one, which keeps its buffers and
+        its cache of encoded names from one worker to the next.
+        """
+        return self.buffered and self.protocol is Protocols.udp
+
+    def make_client(self):
+        """Return a new statsd client for these settings. """
+        if self.protocol is Protocols.udp:
+            if self.buffered:
+                return BufferedStatsClient(**self.config)
+            return StatsClient(**self.config)
+        else:   # self.protocol is Protocols.tcp
+            return TCPStatsClient(**self.config)
+
+
+Settings.__new__.__defaults__ = (False,)
+
+
+class SharedSettings(object):
+
+    """Hold the current `Settings` of all the clients sharing it.
+
+    `reconfigure` replaces the snapshot with a single reference assignment,
+    so that clients always see consistent settings without any locking.
+    """
+
+    def __init__(self, settings):
+        self.current = settings
+        self._client = None
+        self._client_config = None
+
+    @classmethod
+    def from_config(cls, config):
+        """Create the settings from a configuration block.
+
+        The `enabled`, `protocol`, `rates` and `buffered` items are popped
+        from `config`, whatever remains is given to the statsd client.
+        """
+        enabled = config.pop('enabled')
+        protocol = get_protocol(config.pop('protocol', Protocols.udp.name))
+        rates = sort_rates(config.pop('rates', None) or {})
+        buffered = config.pop('buffered', False)
+
+        return cls(Settings(enabled, protocol, config, rates, buffered))
+
+    def reconfigure(
+        self, enabled=None, rates=None, protocol=None, buffered=None,
+        **target
+    ):
+        """Change the settings of all the clients at once.
+
+        Args:
+            enabled (bool): Enable or disable the stats.
+            rates (dict): The sample rates by stat prefix, replacing the
+                current ones.  `{}` removes all the overrides.
+            protocol (str): The protocol of the statsd client.
+            buffered (bool): Whether the UDP client assembles its packets
+                in a preallocated buffer.
+            **target: Arguments of the statsd client to change (`host`,
+                `port`, `prefix`, etc.).
+
+        Returns:
+            The new `Settings`.
+
+        Switching the protocol drops the arguments of the statsd client that
+        only the previous protocol accepts, like `maxudpsize` or `timeout`.
+        When the target changes, a client is created for it before the new
+        settings are applied, so that invalid arguments raise here instead
+        of breaking the stats of all the clients.
+        """
+        current = self.current
+        changes = {}
+
+        if enabled is not None:
+            changes['enabled'] = enabled
+
+        if rates is not None:
+            changes['rates'] = sort_rates(rates)
+
+        if protocol is not None:
+            changes['protocol'] = get_protocol(protocol)
+
+        if buffered is not None:
+            changes['buffered'] = buffered
+
+        config = current.config
+        if changes.get('protocol', current.protocol) is not current.protocol:
+            dropped = (
+                CLIENT_ARGUMENTS[current.protocol] -
+                CLIENT_ARGUMENTS[changes['protocol']]
+            )
+            config = {
+                name: value for name, value in config.items()
+                if name not in dropped
+            }
+
+        settings = current._replace(**changes)
+        if target or protocol is not None or buffered is not None:
+            # a new config makes the clients create a new statsd client
+            settings = settings._replace(config=dict(config, **target))
+            client = settings.make_client()
+            if settings.shared:
+                self._client = client
+                self._client_config = settings.config
+
+        self.current = settings
+        return settings
+
+    def client(self, settings):
+        """Return a statsd client for the `settings` snapshot.
+
+        The shared client (see `Settings.shared`) is created once per
+        snapshot, any other client is created on every call.
+        """
+        if not settings.shared:
+            return settings.make_client()
+
+        if self._client_config is not settings.config:
+            self._client = settings.make_client()
+            self._client_config = settings.config
+        return self._client
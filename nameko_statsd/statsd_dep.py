@@ -1,15 +1,17 @@
-from enum import Enum
+import random
 from functools import wraps, partial
 from mock import MagicMock
 from warnings import warn
 
 from nameko.extensions import DependencyProvider
-from statsd import StatsClient, TCPStatsClient
 
-
-class Protocols(Enum):
-    tcp = 'tcp'
-    udp = 'udp'
+from . import bulk, cputime
+from .cardinality import CardinalityGuard
+from .cputime import DualTimer
+from .heavy_hitters import HeavyHitters
+from .hub import HubLagMonitor
+from .runtime import RuntimeCollector
+from .settings import RATE_POSITIONS, Protocols, SharedSettings  # noqa: F401
 
 
 class LazyClient(object):
@@ -17,30 +19,50 @@ class LazyClient(object):
     """Provide an interface to `StatsClient` with a lazy client creation.
     """
 
-    def __init__(self, **config):
-        self.config = config
-        self.enabled = config.pop('enabled')
+    def __init__(self, settings=None, **config):
+        """
+        Args:
+            settings (SharedSettings): The settings shared with other
+                clients.  Created from `config` if not given.
+            **config: The configuration block of the client.
+        """
+        if settings is None:
+            settings = SharedSettings.from_config(config)
+        self.settings = settings
+        self.guard = None
+        self.heavy_hitters = None
         self._client = None
+        self._client_config = None
 
-        protocol = self.config.pop('protocol', Protocols.udp.name)
+    @property
+    def enabled(self):
+        return self.settings.current.enabled
 
-        try:
-            self.protocol = getattr(Protocols, protocol.lower())
-        except AttributeError:
-            raise ValueError(
-                'Invalid protocol: {}'.format(protocol)
-            )
+    @property
+    def protocol(self):
+        return self.settings.current.protocol
+
+    @property
+    def config(self):
+        return self.settings.current.config
 
     @property
     def client(self):
-        if self._client is None:
-            if self.protocol is Protocols.udp:
-                self._client = StatsClient(**self.config)
-            else:   # self.protocol is Protocols.tcp
-                self._client = TCPStatsClient(**self.config)
+        settings = self.settings.current
+
+        # the client is created again if the target has been reconfigured
+        if self._client is None or self._client_config is not settings.config:
+            self._client = self.settings.client(settings)
+            self._client_config = settings.config
 
         return self._client
 
+    def reconfigure(self, **changes):
+        """Change the settings of this client and of all the clients sharing
+        its settings.  See `SharedSettings.reconfigure`.
+        """
+        return self.settings.reconfigure(**changes)
+
     def __getattr__(self, name):
         if name in ('incr', 'decr', 'gauge', 'set', 'timing'):
             return partial(self._passthrough, name)
@@ -50,25 +72,241 @@ class LazyClient(object):
             )
             raise AttributeError(message)
 
-    def _passthrough(self, name, *args, **kwargs):
-        if self.enabled:
-            return getattr(self.client, name)(*args, **kwargs)
+    def _passthrough(self, name, stat, *args, **kwargs):
+        settings = self.settings.current
+        if settings.enabled:
+            if settings.rates:
+                args, kwargs = settings.override_rate(name, stat, args, kwargs)
+            return getattr(self.client, name)(
+                self._guard_stat(stat), *args, **kwargs
+            )
+
+    def _guard_stat(self, stat):
+        """Return the name `stat` must be sent as, according to the
+        cardinality guard.
 
-    def timer(self, *args, **kwargs):
-        if self.enabled:
-            return self.client.timer(*args, **kwargs)
+        Every stat name sent goes through here, so it is also where the heavy
+        hitters are tracked.
+        """
+        if self.heavy_hitters is not None:
+            self.heavy_hitters.observe_stat(stat)
+
+        guard = self.guard
+        if guard is None or guard.admit(stat):
+            return stat
+
+        return guard.bucket
+
+    def timer(self, stat, *args, **kwargs):
+        settings = self.settings.current
+        if settings.enabled:
+            if settings.rates:
+                args, kwargs = settings.override_rate(
+                    'timer', stat, args, kwargs
+                )
+            return self.client.timer(self._guard_stat(stat), *args, **kwargs)
         else:
             return MagicMock()
 
+    def dual_timer(self, stat, rate=1):
+        """Time a block both in wall time and in CPU time.
+
+        Send the `<stat>.wall` and `<stat>.cpu` timings, see `DualTimer`.
+        """
+        settings = self.settings.current
+        if settings.enabled:
+            if settings.rates:
+                override = settings.rate(stat)
+                if override is not None:
+                    rate = override
+            return DualTimer(self, stat, rate)
+        else:
+            return MagicMock()
+
+    def timings(self, timings, rate=1):
+        """Send timings in a single packet, sampled together: either all of
+        them are sent, or none.
+
+        Args:
+            timings (list): The `(stat, milliseconds)` pairs.
+            rate (float): The sample rate.
+        """
+        if not self.enabled:
+            return
+
+        if rate < 1:
+            if random.random() > rate:
+                return
+            value = '%0.6f|ms|@{}'.format(rate)
+        else:
+            value = '%0.6f|ms'
+
+        with self.client.pipeline() as pipe:
+            for stat, ms in timings:
+                # already sampled, so the sample rate is part of the value
+                pipe._send_stat(self._guard_stat(stat), value % ms, 1)
+
     def pipeline(self, *args, **kwargs):
-        if self.enabled:
-            return self.client.pipeline(*args, **kwargs)
+        settings = self.settings.current
+        if settings.enabled:
+            return self._pipeline(settings, *args, **kwargs)
         else:
             return MagicMock()
 
+    def _pipeline(self, settings, *args, **kwargs):
+        return GuardedPipeline(
+            self.client.pipeline(*args, **kwargs), self, settings
+        )
+
+    def incr_many(self, stats, counts=None):
+        """Increment many counters, aggregating the counts client side.
+
+        Args:
+            stats (str or iterable): Either a single stat name, or one stat
+                name per count.
+            counts (iterable or numpy.ndarray): The counts, summed by stat
+                name.  Defaults to `1` for each name in `stats`.
+
+        Only one increment per distinct stat name is sent, packed with the
+        others into as few packets as possible.
+        """
+        settings = self.settings.current
+        if not settings.enabled:
+            return
+
+        if counts is None:
+            if isinstance(stats, str):
+                counts = [1]
+            else:
+                stats = list(stats)
+                counts = [1] * len(stats)
+
+        with self._pipeline(settings) as pipe:
+            for name, total in bulk.sums(stats, counts):
+                pipe.incr(name, total)
+
+    def timing_many(
+        self, stats, values, percentiles=(50, 90, 99), aggregate=False
+    ):
+        """Send many timings, packed into as few packets as possible.
+
+        Args:
+            stats (str or iterable): Either a single stat name, or one stat
+                name per value.
+            values (iterable or numpy.ndarray): The timings in milliseconds.
+            percentiles (list): The percentiles to compute, if `aggregate`.
+            aggregate (bool): Send the statistics of the timings, computed
+                client side, instead of the timings themselves.
+
+        By default every timing is sent, so that the statsd server aggregates
+        them as usual.  With `aggregate`, for each distinct stat name,
+        `<stat>.count` is incremented by the number of timings, and the
+        `<stat>.mean`, `<stat>.min`, `<stat>.max` and `<stat>.p<N>` gauges are
+        sent.  A gauge only keeps its last value, so those statistics are
+        only meaningful with a single call per stat name and statsd flush
+        interval, across all the processes.
+        """
+        settings = self.settings.current
+        if not settings.enabled:
+            return
+
+        if not aggregate:
+            with self._pipeline(settings) as pipe:
+                for name, timings in bulk.samples(stats, values):
+                    for timing in timings:
+                        pipe.timing(name, timing)
+            return
+
+        with self._pipeline(settings) as pipe:
+            for name, summary in bulk.summaries(stats, values, percentiles):
+                for suffix, value in summary:
+                    stat = '{}.{}'.format(name, suffix)
+                    if suffix == 'count':
+                        pipe.incr(stat, value)
+                    else:
+                        pipe.gauge(stat, value)
+
+    def gauge_many(self, stats, values):
+        """Set many gauges, sending only the last value of each.
+
+        Args:
+            stats (str or iterable): Either a single stat name, or one stat
+                name per value.
+            values (iterable or numpy.ndarray): The values.
+        """
+        settings = self.settings.current
+        if not settings.enabled:
+            return
+
+        with self._pipeline(settings) as pipe:
+            for name, value in bulk.lasts(stats, values):
+                pipe.gauge(name, value)
+
+
+class GuardedPipeline(object):
+
+    """Send the stats of a statsd `pipeline` like those sent by `client`
+    itself: through its cardinality guard and with the sample rate overrides
+    of `settings`.
+    """
+
+    def __init__(self, pipeline, client, settings):
+        self._pipeline = pipeline
+        self._client = client
+        self._settings = settings
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    # the stat methods are defined explicitly, as they are called for every
+    # stat of the pipeline
+
+    def incr(self, stat, *args, **kwargs):
+        return self._guarded('incr', stat, args, kwargs)
+
+    def decr(self, stat, *args, **kwargs):
+        return self._guarded('decr', stat, args, kwargs)
+
+    def gauge(self, stat, *args, **kwargs):
+        return self._guarded('gauge', stat, args, kwargs)
+
+    def set(self, stat, *args, **kwargs):
+        return self._guarded('set', stat, args, kwargs)
+
+    def timing(self, stat, *args, **kwargs):
+        return self._guarded('timing', stat, args, kwargs)
+
+    def timer(self, stat, *args, **kwargs):
+        return self._guarded('timer', stat, args, kwargs)
+
+    def _guarded(self, name, stat, args, kwargs):
+        settings = self._settings
+        if settings.rates:
+            args, kwargs = settings.override_rate(name, stat, args, kwargs)
+        return getattr(self._pipeline, name)(
+            self._client._guard_stat(stat), *args, **kwargs
+        )
+
+    def __enter__(self):
+        return GuardedPipeline(
+            self._pipeline.__enter__(), self._client, self._settings
+        )
+
+    def __exit__(self, typ, value, tb):
+        return self._pipeline.__exit__(typ, value, tb)
+
+    def pipeline(self):
+        return GuardedPipeline(
+            self._pipeline.pipeline(), self._client, self._settings
+        )
+
 
 class StatsD(DependencyProvider):
 
+    # whether the `dual_timer` decorator is used in the service class
+    _dual_timers = False
+    _cpu_clock_acquired = False
+
     def __init__(self, key, name=None, *args, **kwargs):
         """
         Args:
@@ -86,16 +324,126 @@ class StatsD(DependencyProvider):
 
         super(StatsD, self).__init__(*args, **kwargs)
 
+    def bind(self, container, attr_name):
+        instance = super(StatsD, self).bind(container, attr_name)
+        instance._dual_timers = self._dual_timers
+        return instance
+
     def get_dependency(self, worker_ctx):
-        return LazyClient(**self.config)
+        dependency = LazyClient(settings=self.settings)
+        dependency.guard = self.cardinality_guard
+        dependency.heavy_hitters = self.heavy_hitters
+        return dependency
 
     def setup(self):
-        self.config = self.get_config()
+        self.config = dict(self.get_config())
+        hub_lag = self.config.pop('hub_lag', None)
+        runtime_metrics = self.config.pop('runtime_metrics', None)
+        heavy_hitters = self.config.pop('heavy_hitters', None)
+        cardinality = self.config.pop('cardinality', None)
+        self.cpu_time = self.config.pop('cpu_time', self._dual_timers)
+
+        self.settings = SharedSettings.from_config(dict(self.config))
+
+        # the guard is created first, as the other background clients use it
+        self.cardinality_guard = None
+        self.cardinality_guard = self._make_background(
+            CardinalityGuard, cardinality
+        )
+        self.hub_lag_monitor = self._make_background(HubLagMonitor, hub_lag)
+        self.runtime_collector = self._make_background(
+            RuntimeCollector, runtime_metrics, container=self.container
+        )
+        self.heavy_hitters = self._make_background(
+            HeavyHitters, heavy_hitters
+        )
+
         return super(StatsD, self).setup()
 
+    def start(self):
+        # started from the hub thread, the one the workers run in
+        if self.cpu_time:
+            cputime.clock.acquire()
+            self._cpu_clock_acquired = True
+
+        self._background_threads = [
+            self.container.spawn_managed_thread(background.run)
+            for background in self._background
+        ]
+
+        return super(StatsD, self).start()
+
+    def stop(self):
+        for background in self._background:
+            background.stop()
+
+        for thread in self._background_threads:
+            thread.kill()
+
+        self._release_cpu_clock()
+
+        return super(StatsD, self).stop()
+
+    def kill(self):
+        self._release_cpu_clock()
+
+        return super(StatsD, self).kill()
+
+    def _release_cpu_clock(self):
+        if self._cpu_clock_acquired:
+            self._cpu_clock_acquired = False
+            cputime.clock.release()
+
+    @property
+    def _background(self):
+        return [
+            background for background in (
+                self.hub_lag_monitor, self.runtime_collector,
+                self.heavy_hitters, self.cardinality_guard,
+            ) if background is not None
+        ]
+
+    def _make_background(self, cls, options, **kwargs):
+        """Create the `cls` background task if `options` enable it.
+
+        `options` is either `True` (use the defaults) or a dictionary of
+        keyword arguments for `cls`.
+        """
+        options = self._options(options)
+        if options is None:
+            return None
+
+        client = LazyClient(settings=self.settings)
+        client.guard = self.cardinality_guard
+
+        return cls(client, **dict(options, **kwargs))
+
+    @staticmethod
+    def _options(value):
+        """Return the keyword arguments of an optional feature, given its
+        configuration `value`: `True` to use the defaults, or a dictionary.
+
+        Return `None` if the feature is disabled.
+        """
+        if not value:
+            return None
+
+        return {} if value is True else value
+
     def get_config(self):
         return self.container.config['STATSD'][self._key]
 
+    def reconfigure(self, **changes):
+        """Change the settings of all the workers, current and future.
+
+        Args:
+            **changes: See `SharedSettings.reconfigure`.
+
+        Returns:
+            The new `Settings`.
+        """
+        return self.settings.reconfigure(**changes)
+
     def timer(self, *targs, **tkwargs):
         """Decorate a nameko service method.
 
@@ -130,10 +478,26 @@ class StatsD(DependencyProvider):
 
                 @rpc (or @http or even nothing)
                 def method(...):
-                    with self.statsd.client.timer('my_stat', rate=5):
+                    with self.statsd.timer('my_stat', rate=5):
                         # method body
 
         """
+        return self._timer_decorator('timer', targs, tkwargs)
+
+    def dual_timer(self, *targs, **tkwargs):
+        """Decorate a nameko service method, like `timer`, sending both its
+        wall time and its CPU time.
+
+        Args:
+            *targs: Positional arguments to be given to
+                `LazyClient.dual_timer()`.
+            *tkwargs: Keyword arguments to be given to
+                `LazyClient.dual_timer()`.
+        """
+        self._dual_timers = True
+        return self._timer_decorator('dual_timer', targs, tkwargs)
+
+    def _timer_decorator(self, timer_name, targs, tkwargs):
         def decorator(method):
 
             @wraps(method)
@@ -147,8 +511,15 @@ class StatsD(DependencyProvider):
                 dependency = getattr(svc, self.attr_name)
 
                 if dependency.enabled:
-                    with dependency.client.timer(*targs, **tkwargs):
-                        res = method(svc, *args, **kwargs)
+                    timer = getattr(dependency, timer_name)
+                    heavy_hitters = dependency.heavy_hitters
+
+                    with timer(*targs, **tkwargs):
+                        if heavy_hitters is None:
+                            res = method(svc, *args, **kwargs)
+                        else:
+                            with heavy_hitters.timed(method.__qualname__):
+                                res = method(svc, *args, **kwargs)
                 else:
                     res = method(svc, *args, **kwargs)
 
@@ -0,0 +1,304 @@
+"""UDP transport assembling the packets in preallocated buffers.
+
+`statsd.StatsClient` formats each line as a string, joins the lines of a
+pipeline into a new string and encodes it before sending it.
+`BufferedStatsClient` writes the fragments of each line (the cached encoded
+stat name, the value formatted as bytes, the type and the sample rate)
+straight into a `bytearray` of `maxudpsize` bytes, and sends a `memoryview`
+of it.  The buffers are reused: the client keeps a pool of them, and each
+pipeline takes one from the pool until it is sent.
+"""
+import random
+import socket
+from datetime import timedelta
+
+from statsd import StatsClient
+from statsd.client.base import StatsClientBase
+
+
+# values of the small counts, the most common ones
+_SMALL_INTS = tuple(b'%d' % value for value in range(256))
+
+_RATES = {}
+_MAX_RATES = 100
+
+
+def format_value(value):
+    """Return the statsd representation of `value` as bytes, the one of
+    `'%s' % value`.
+    """
+    if type(value) is int:
+        if 0 <= value < 256:
+            return _SMALL_INTS[value]
+        return b'%d' % value
+    if type(value) is float:
+        return b'%r' % value
+    return str(value).encode('ascii')
+
+
+def rate_suffix(rate):
+    """Return the `|@<rate>` bytes of a sample rate, cached. """
+    try:
+        return _RATES[rate]
+    except KeyError:
+        pass
+
+    if len(_RATES) >= _MAX_RATES:
+        _RATES.clear()
+
+    suffix = _RATES[rate] = b'|@' + format_value(rate)
+    return suffix
+
+
+class StatNames(object):
+
+    """Cache of the encoded `<prefix>.<stat>:` bytes of the stat names. """
+
+    def __init__(self, prefix=None, max_names=1000):
+        """
+        Args:
+            prefix (str): The prefix of all the stat names.
+            max_names (int): The maximum number of names cached.
+        """
+        self.prefix = prefix
+        self.max_names = max_names
+        self._names = {}
+
+    def get(self, stat):
+        try:
+            return self._names[stat]
+        except KeyError:
+            pass
+
+        if len(self._names) >= self.max_names:
+            self._names.clear()
+
+        if self.prefix:
+            name = '{}.{}:'.format(self.prefix, stat).encode('ascii')
+        else:
+            name = '{}:'.format(stat).encode('ascii')
+        self._names[stat] = name
+        return name
+
+
+class PacketWriter(object):
+
+    """Write statsd lines into a preallocated buffer of `size` bytes.
+
+    Lines are joined into packets shorter than `size` bytes, like
+    `statsd.StatsClient` does.  When the next line does not fit, the buffer
+    is flushed: its content is given to `send` as a `memoryview`, which is
+    only valid during the call.
+    """
+
+    def __init__(self, send, size=512, names=None):
+        """
+        Args:
+            send (callable): Called with each packet.
+            size (int): The size of the buffer, `maxudpsize`.
+            names (StatNames): The cache of the encoded stat names.
+        """
+        self.send = send
+        self.size = size
+        self.names = names if names is not None else StatNames()
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.length = 0
+
+    def write(self, stat, value, suffix, rate=1, plus=False, reset=False):
+        """Write a line for `stat`.
+
+        Args:
+            stat (str): The stat name, without prefix.
+            value (bytes): The formatted value.
+            suffix (bytes): The type of the stat, like `b'|c'`.
+            rate (float): The sample rate, sent if lower than `1`.
+            plus (bool): Prefix the value with `+`, for gauge deltas.
+            reset (bool): Precede the line with a `0|g` line for the same
+                stat, in the same packet, for negative gauges.
+        """
+        name = self.names.get(stat)
+        rate = rate_suffix(rate) if rate < 1 else b''
+
+        size = len(name) + plus + len(value) + len(suffix) + len(rate)
+        if reset:
+            size += len(name) + 4
+
+        length = self.length
+        start = length + 1 if length else 0
+        if length and start + size >= self.size:
+            self.flush()
+            start = 0
+
+        end = start + size
+        if end > self.size:
+            # a line larger than the buffer is sent on its own
+            parts = [name, b'0|g\n', name] if reset else [name]
+            parts.extend((b'+' if plus else b'', value, suffix, rate))
+            self.send(b''.join(parts))
+            return
+
+        view = self.view
+        if start:
+            view[length] = 10  # b'\n'
+
+        if reset:
+            position = start + len(name)
+            view[start:position] = name
+            start = position + 4
+            view[position:start] = b'0|g\n'
+
+        position = start + len(name)
+        view[start:position] = name
+        if plus:
+            view[position] = 43  # b'+'
+            position += 1
+        start = position + len(value)
+        view[position:start] = value
+        position = start + len(suffix)
+        view[start:position] = suffix
+        if rate:
+            view[position:end] = rate
+
+        self.length = end
+
+    def flush(self):
+        if self.length:
+            self.send(self.view[:self.length])
+            self.length = 0
+
+
+class BufferedMethods(object):
+
+    """The stat methods of `StatsClientBase`, writing the lines with a
+    `PacketWriter`.
+
+    Subclasses provide `_write`, called with the arguments of
+    `PacketWriter.write`.
+    """
+
+    def incr(self, stat, count=1, rate=1):
+        if rate < 1 and random.random() > rate:
+            return
+        self._write(stat, format_value(count), b'|c', rate)
+
+    def decr(self, stat, count=1, rate=1):
+        self.incr(stat, -count, rate)
+
+    def gauge(self, stat, value, rate=1, delta=False):
+        if rate < 1 and random.random() > rate:
+            return
+
+        if value < 0 and not delta:
+            # a negative value would be read as a decrement, so the gauge
+            # is reset first, in the same packet
+            self._write(stat, format_value(value), b'|g', 1, False, True)
+        else:
+            self._write(
+                stat, format_value(value), b'|g', rate, delta and value >= 0
+            )
+
+    def set(self, stat, value, rate=1):
+        if rate < 1 and random.random() > rate:
+            return
+        self._write(stat, format_value(value), b'|s', rate)
+
+    def timing(self, stat, delta, rate=1):
+        if rate < 1 and random.random() > rate:
+            return
+        if isinstance(delta, timedelta):
+            delta = delta.total_seconds() * 1000.
+        self._write(stat, b'%0.6f' % delta, b'|ms', rate)
+
+    def _send_stat(self, stat, value, rate):
+        # the `StatsClientBase` method the callers formatting their own
+        # value use, like `LazyClient.timings`
+        if rate < 1 and random.random() > rate:
+            return
+        self._write(stat, value.encode('ascii'), b'', rate)
+
+
+class BufferedPipeline(BufferedMethods, StatsClientBase):
+
+    """Pipeline writing its lines into a buffer taken from the pool of its
+    client, until `send`.
+
+    The buffer is flushed whenever it is full, and given back to the pool by
+    `send`.  The lines of a pipeline that is never sent are never sent, and
+    a nested pipeline sends its lines on its own `send`.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._writer = None
+
+    def _write(self, stat, value, suffix, rate=1, plus=False, reset=False):
+        writer = self._writer
+        if writer is None:
+            writer = self._writer = self._client._acquire_writer()
+        writer.write(stat, value, suffix, rate, plus, reset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.send()
+
+    def send(self):
+        writer = self._writer
+        if writer is not None:
+            self._writer = None
+            writer.flush()
+            self._client._release_writer(writer)
+
+    def pipeline(self):
+        return self.__class__(self._client)
+
+
+class BufferedStatsClient(BufferedMethods, StatsClient):
+
+    """`StatsClient` assembling its packets in preallocated buffers.
+
+    At most `max_writers` buffers are kept in the pool, more are created
+    when more pipelines are in use at the same time.
+    """
+
+    max_writers = 16
+
+    def __init__(self, host='localhost', port=8125, prefix=None,
+                 maxudpsize=512, ipv6=False):
+        super(BufferedStatsClient, self).__init__(
+            host=host, port=port, prefix=prefix, maxudpsize=maxudpsize,
+            ipv6=ipv6,
+        )
+        self._names = StatNames(prefix)
+        self._writers = []
+
+    def _acquire_writer(self):
+        writers = self._writers
+        if writers:
+            return writers.pop()
+        return PacketWriter(self._send_packet, self._maxudpsize, self._names)
+
+    def _release_writer(self, writer):
+        if len(self._writers) < self.max_writers:
+            self._writers.append(writer)
+
+    def _write(self, stat, value, suffix, rate=1, plus=False, reset=False):
+        # `_acquire_writer` and `_release_writer`, inlined on the path of
+        # every stat sent on its own
+        writers = self._writers
+        writer = writers.pop() if writers else self._acquire_writer()
+        writer.write(stat, value, suffix, rate, plus, reset)
+        writer.flush()
+        if len(writers) < self.max_writers:
+            writers.append(writer)
+
+    def _send_packet(self, data):
+        try:
+            self._sock.sendto(data, self._addr)
+        except (socket.error, RuntimeError):
+            pass
+
+    def pipeline(self):
+        return BufferedPipeline(self)
@@ -24,6 +24,7 @@ setup(
     install_requires=reqs('requirements/base.txt'),
     extras_require={
         'dev': reqs('requirements/dev.txt'),
+        'numpy': ['numpy'],
     },
     zip_safe=True,
     license='MIT License',
@@ -0,0 +1,120 @@
+from mock import patch
+import numpy
+import pytest
+
+from nameko_statsd import bulk
+
+
+@pytest.fixture(autouse=True, params=['numpy', 'python'])
+def implementation(request):
+    """Run every test with and without NumPy. """
+    if request.param == 'python':
+        with patch('nameko_statsd.bulk.numpy', None):
+            yield request.param
+    else:
+        yield request.param
+
+
+@pytest.mark.parametrize('stats, values, expected', [
+    ('a', [1, 2, 3], [('a', [1, 2, 3])]),
+    ('a', numpy.arange(3), [('a', [0, 1, 2])]),
+    (['b', 'a', 'b'], [1, 2, 3], [('a', [2]), ('b', [1, 3])]),
+    (['b', 'a', 'b'], numpy.array([1, 2, 3]), [('a', [2]), ('b', [1, 3])]),
+    (numpy.array(['x', 'y', 'x', 'x']), [4, 3, 2, 1], [
+        ('x', [4, 2, 1]), ('y', [3])
+    ]),
+    ([], [], []),
+])
+def test_group(stats, values, expected):
+    result = bulk.group(stats, values)
+
+    assert [(name, list(group)) for name, group in result] == expected
+
+
+def test_group_iterators():
+    stats = (name for name in ['b', 'a', 'b'])
+    values = (value for value in [1, 2, 3])
+
+    result = bulk.group(stats, values)
+
+    assert [(name, list(group)) for name, group in result] == [
+        ('a', [2]), ('b', [1, 3])
+    ]
+
+
+@pytest.mark.parametrize('stats, values', [
+    (['a', 'b', 'c'], [1, 2]),
+    (['a'], numpy.array([1, 2])),
+])
+def test_group_length_mismatch(stats, values):
+    with pytest.raises(ValueError) as err:
+        bulk.group(stats, values)
+
+    assert err.match(
+        'Got {} stat names for {} values'.format(len(stats), len(values))
+    )
+
+
+def test_samples():
+    result = bulk.samples(['b', 'a', 'b'], numpy.array([1, 2, 3]))
+
+    assert result == [('a', [2.0]), ('b', [1.0, 3.0])]
+    assert all(
+        type(value) in (int, float) for _, values in result for value in values
+    )
+
+
+def test_sums():
+    assert bulk.sums(['a', 'b', 'a'], [1, 2, 3]) == [('a', 4), ('b', 2)]
+    assert bulk.sums('a', numpy.array([1, 2, 3])) == [('a', 6)]
+
+
+def test_lasts():
+    assert bulk.lasts(['a', 'b', 'a'], [1, 2, 3]) == [('a', 3), ('b', 2)]
+    assert bulk.lasts('a', numpy.array([1.5, 2.5])) == [('a', 2.5)]
+    assert bulk.lasts('a', []) == []
+
+
+def test_summaries():
+    result = bulk.summaries(
+        ['a', 'b', 'a', 'a', 'a', 'a'], [50, 7, 10, 40, 20, 30], (50, 90)
+    )
+
+    assert result == [
+        ('a', [
+            ('count', 5),
+            ('mean', 30.0),
+            ('min', 10),
+            ('max', 50),
+            ('p50', 30),
+            ('p90', 50),
+        ]),
+        ('b', [
+            ('count', 1),
+            ('mean', 7.0),
+            ('min', 7),
+            ('max', 7),
+            ('p50', 7),
+            ('p90', 7),
+        ]),
+    ]
+
+
+def test_summaries_empty():
+    assert bulk.summaries('a', [], (50,)) == []
+
+
+def test_summaries_types(implementation):
+    (_, summary), = bulk.summaries('a', numpy.arange(1000.0), (99,))
+
+    assert summary == [
+        ('count', 1000),
+        ('mean', 499.5),
+        ('min', 0),
+        ('max', 999),
+        ('p99', 989),
+    ]
+    # values are plain Python numbers, formatted as such in the packets
+    assert all(
+        type(value) in (int, float) for _, value in summary
+    )
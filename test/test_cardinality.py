@@ -0,0 +1,226 @@
+import eventlet
+from mock import MagicMock, call, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+
+from nameko_statsd.cardinality import CardinalityGuard
+from nameko_statsd.statsd_dep import LazyClient, StatsD
+
+
+class TestCardinalityGuard(object):
+
+    def test_admit(self):
+        guard = CardinalityGuard(MagicMock(), limit=2)
+
+        assert guard.admit('a')
+        assert guard.admit('b')
+        assert guard.admit('a')
+        assert not guard.admit('c')
+        assert not guard.admit('d')
+        assert guard.admit('b')
+
+        assert guard.names == {'a', 'b'}
+        assert guard.overflows == 2
+
+    def test_defaults(self):
+        guard = CardinalityGuard(MagicMock())
+
+        assert guard.limit == 1000
+        assert guard.bucket == 'cardinality.other'
+        assert guard.stat == 'cardinality.overflow'
+        assert guard.interval == 10
+
+    def test_report(self):
+        client = MagicMock()
+        guard = CardinalityGuard(client, limit=0, stat='overflow')
+
+        guard.report()
+        for name in 'abc':
+            guard.admit(name)
+        guard.report()
+        guard.admit('d')
+        guard.report()
+        guard.report()
+
+        assert client.incr.call_args_list == [
+            call('overflow', 3), call('overflow', 1),
+        ]
+        assert guard.overflows == 4
+
+    def test_run(self):
+        client = MagicMock()
+        guard = CardinalityGuard(client, limit=0, interval=0.01)
+        guard.admit('a')
+
+        gt = eventlet.spawn(guard.run)
+        eventlet.sleep(0.015)
+        guard.stop()
+        gt.wait()
+
+        assert client.incr.call_args_list == [
+            call('cardinality.overflow', 1)
+        ]
+
+
+class TestLazyClientGuard(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.fixture
+    def lazy_client(self, stats_config):
+        lc = LazyClient(**stats_config['STATSD']['test'])
+        lc.guard = CardinalityGuard(
+            MagicMock(), limit=1, bucket='other', stat='overflow'
+        )
+        return lc
+
+    @pytest.mark.parametrize('method', [
+        'incr', 'decr', 'gauge', 'set', 'timing', 'timer',
+    ])
+    def test_methods(self, lazy_client, method):
+        getattr(lazy_client, method)('user.1', 5)
+        getattr(lazy_client, method)('user.2', 5)
+        getattr(lazy_client, method)(stat='user.1')
+
+        assert getattr(lazy_client.client, method).call_args_list == [
+            call('user.1', 5), call('other', 5), call('user.1'),
+        ]
+        assert lazy_client.guard.overflows == 1
+        # refusals are only reported by the guard itself
+        assert lazy_client.guard.client.incr.call_args_list == []
+
+    def test_bulk_methods(self, lazy_client):
+        pipe = lazy_client.client.pipeline.return_value.__enter__.return_value
+
+        lazy_client.incr_many(['user.1', 'user.2', 'user.1'])
+        lazy_client.gauge_many(['user.1', 'user.2'], [1, 2])
+        lazy_client.timing_many('t', [1.0], percentiles=(), aggregate=True)
+
+        assert pipe.incr.call_args_list == [
+            call('user.1', 2), call('other', 1), call('other', 1),
+        ]
+        assert pipe.gauge.call_args_list == [
+            call('user.1', 1), call('other', 2), call('other', 1.0),
+            call('other', 1.0), call('other', 1.0),
+        ]
+        assert lazy_client.guard.overflows == 6
+        assert lazy_client.client.incr.call_args_list == []
+
+    def test_pipeline(self, lazy_client):
+        pipeline = lazy_client.client.pipeline.return_value
+        pipe = pipeline.__enter__.return_value
+        nested = pipe.pipeline.return_value.__enter__.return_value
+
+        with lazy_client.pipeline() as guarded:
+            for user in range(3):
+                guarded.incr('user.{}'.format(user))
+            guarded.timer('user.0', rate=0.5)
+            with guarded.pipeline() as guarded_nested:
+                guarded_nested.gauge('user.3', 1)
+
+        assert pipe.incr.call_args_list == [
+            call('user.0'), call('other'), call('other'),
+        ]
+        assert pipe.timer.call_args_list == [call('user.0', rate=0.5)]
+        assert nested.gauge.call_args_list == [call('other', 1)]
+        assert lazy_client.guard.overflows == 3
+
+    def test_pipeline_real_client(self, stats_config):
+        config = dict(
+            stats_config['STATSD']['test'], host='localhost', buffered=True
+        )
+        lc = LazyClient(**config)
+        lc.guard = CardinalityGuard(
+            MagicMock(), limit=2, bucket='other', stat='overflow'
+        )
+        packets = []
+        lc.client._send_packet = lambda data: packets.append(bytes(data))
+
+        with lc.pipeline() as pipe:
+            for user in range(5):
+                pipe.incr('user.{}'.format(user))
+
+        assert packets == [b'\n'.join(
+            b'statsd.prefix.' + name + b':1|c'
+            for name in (b'user.0', b'user.1', b'other', b'other', b'other')
+        )]
+
+    def test_no_guard(self, stats_config):
+        lc = LazyClient(**stats_config['STATSD']['test'])
+
+        for user in range(10):
+            lc.incr('user.{}'.format(user))
+
+        assert len(lc.client.incr.call_args_list) == 10
+
+
+class CardinalityService(object):
+
+    name = 'cardinality_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    @statsd.timer('method')
+    def method(self, user):
+        self.statsd.incr('user.{}'.format(user))
+
+
+class TestStatsDCardinality(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.mark.parametrize('cardinality, limit', [
+        (True, 1000), ({'limit': 2}, 2),
+    ])
+    def test_guard_shared_by_workers(
+        self, container_factory, stats_config, stats_client_cls,
+        cardinality, limit
+    ):
+        stats_config['STATSD']['test']['cardinality'] = cardinality
+
+        container = container_factory(CardinalityService, stats_config)
+        container.start()
+
+        statsd = next(iter(container.dependencies))
+        assert statsd.cardinality_guard.limit == limit
+        assert 'cardinality' not in statsd.config
+
+        for user in range(3):
+            with entrypoint_hook(container, 'method') as method:
+                method(user)
+
+        client = stats_client_cls.return_value
+        if limit == 2:
+            assert statsd.cardinality_guard.names == {'method', 'user.0'}
+            assert client.incr.call_args_list == [
+                call('user.0'),
+                call('cardinality.other'),
+                call('cardinality.other'),
+            ]
+
+            statsd.cardinality_guard.report()
+            assert client.incr.call_args_list[-1] == call(
+                'cardinality.overflow', 2
+            )
+        else:
+            assert len(statsd.cardinality_guard.names) == 4
+
+        container.stop()
+        assert statsd.cardinality_guard._running is False
+
+    def test_no_guard(self, container_factory, stats_config):
+        container = container_factory(CardinalityService, stats_config)
+        container.start()
+
+        statsd = next(iter(container.dependencies))
+        assert statsd.cardinality_guard is None
+
+        with entrypoint_hook(container, 'method') as method:
+            method(1)
@@ -0,0 +1,364 @@
+import eventlet
+import greenlet
+from eventlet import patcher
+from mock import MagicMock, Mock, call, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+
+from nameko_statsd import cputime
+from nameko_statsd.cputime import DualTimer, GreenletCpuClock
+from nameko_statsd.statsd_dep import LazyClient, StatsD
+
+
+def burn_cpu(seconds):
+    end = cputime.thread_time_ns() + seconds * 1e9
+    while cputime.thread_time_ns() < end:
+        pass
+
+
+class TestGreenletCpuClock(object):
+
+    @pytest.fixture
+    def clock(self):
+        clock = GreenletCpuClock()
+        clock.install()
+        yield clock
+        clock.uninstall()
+
+    def test_greenthreads_accounted_separately(self, clock):
+
+        def busy():
+            start = clock.cpu_time_ns()
+            eventlet.sleep(0)
+            burn_cpu(0.05)
+            eventlet.sleep(0)
+            return clock.cpu_time_ns() - start
+
+        def idle():
+            start = clock.cpu_time_ns()
+            eventlet.sleep(0.1)
+            return clock.cpu_time_ns() - start
+
+        busy_gt = eventlet.spawn(busy)
+        idle_gt = eventlet.spawn(idle)
+
+        assert busy_gt.wait() >= 0.05e9
+        assert idle_gt.wait() < 0.01e9
+
+    def test_other_os_thread(self, clock):
+        result = []
+
+        def run():
+            result.append(clock.cpu_time_ns())
+
+        thread = patcher.original('threading').Thread(target=run)
+        thread.start()
+        thread.join()
+
+        # only the CPU time of that thread, which has hardly run
+        assert 0 < result[0] < 0.05e9
+
+    @patch('nameko_statsd.cputime.thread_time_ns', side_effect=[10, 25, 40])
+    def test_trace(self, thread_time_ns):
+        clock = GreenletCpuClock()
+        clock._last = 0
+        origin, target = greenlet.greenlet(), greenlet.greenlet()
+
+        clock._trace('switch', (origin, target))
+        clock._previous_trace = Mock()
+        clock._trace('throw', (target, origin))
+        clock._trace('switch', (origin, target))
+
+        assert clock._times[origin] == 10 + 15
+        assert clock._times[target] == 15
+        assert clock._previous_trace.call_args_list == [
+            call('throw', (target, origin)),
+            call('switch', (origin, target)),
+        ]
+
+    @patch('nameko_statsd.cputime.thread_time_ns', Mock(return_value=123))
+    def test_not_installed_thread(self):
+        clock = GreenletCpuClock()
+        clock.thread_id = -1
+
+        assert clock.cpu_time_ns() == 123
+
+    def test_previous_trace_called(self):
+        previous = Mock()
+        old = greenlet.settrace(previous)
+        try:
+            clock = GreenletCpuClock()
+            clock.install()
+            eventlet.sleep(0)
+            clock.uninstall()
+        finally:
+            greenlet.settrace(old)
+
+        assert previous.call_args_list[0][0][0] == 'switch'
+
+    def test_acquire_release(self):
+        clock = GreenletCpuClock()
+        old = greenlet.gettrace()
+
+        clock.acquire()
+        clock.acquire()
+        assert greenlet.gettrace() == clock._trace
+
+        clock.release()
+        assert greenlet.gettrace() == clock._trace
+
+        clock.release()
+        assert greenlet.gettrace() is old
+        assert clock.thread_id is None
+        assert len(clock._times) == 0
+
+
+@patch('nameko_statsd.cputime.thread_time_ns', Mock(return_value=123))
+def test_cpu_time_ns_not_installed():
+    assert cputime.clock.thread_id is None
+    assert cputime.cpu_time_ns() == 123
+
+
+class TestDualTimer(object):
+
+    @patch('nameko_statsd.cputime.cpu_time_ns', side_effect=[1e6, 3e6])
+    @patch('nameko_statsd.cputime.perf_counter_ns', side_effect=[5e6, 15e6])
+    def test_timings(self, perf_counter_ns, cpu_time_ns):
+        client = Mock()
+
+        with DualTimer(client, 'stat', rate=0.5) as timer:
+            pass
+
+        assert timer.wall_ms == 10.0
+        assert timer.cpu_ms == 2.0
+        assert client.timings.call_args_list == [
+            call([('stat.wall', 10.0), ('stat.cpu', 2.0)], 0.5),
+        ]
+
+    @patch('nameko_statsd.cputime.cpu_time_ns')
+    @patch('nameko_statsd.cputime.perf_counter_ns')
+    def test_clocks_order(self, perf_counter_ns, cpu_time_ns):
+        reads = []
+        perf_counter_ns.side_effect = lambda: reads.append('wall') or 0
+        cpu_time_ns.side_effect = lambda: reads.append('cpu') or 0
+
+        with DualTimer(Mock(), 'stat'):
+            assert reads == ['wall', 'cpu']
+
+        assert reads == ['wall', 'cpu', 'cpu', 'wall']
+
+    @patch('nameko_statsd.cputime.cpu_time_ns', side_effect=[0, 4000])
+    @patch('nameko_statsd.cputime.perf_counter_ns', side_effect=[0, 900])
+    def test_cpu_capped_at_wall(self, perf_counter_ns, cpu_time_ns):
+        client = Mock()
+
+        with DualTimer(client, 'stat') as timer:
+            pass
+
+        assert timer.cpu_ms == timer.wall_ms == 0.0009
+        assert client.timings.call_args_list == [
+            call([('stat.wall', 0.0009), ('stat.cpu', 0.0009)], 1),
+        ]
+
+    def test_short_blocks(self):
+        cputime.clock.acquire()
+        try:
+            timers = [DualTimer(Mock(), 'stat') for _ in range(1000)]
+            for timer in timers:
+                with timer:
+                    pass
+        finally:
+            cputime.clock.release()
+
+        assert all(timer.cpu_ms <= timer.wall_ms for timer in timers)
+
+    def test_cpu_bound_block(self):
+        client = Mock()
+
+        cputime.clock.acquire()
+        try:
+            with DualTimer(client, 'stat') as busy:
+                burn_cpu(0.02)
+
+            with DualTimer(client, 'stat') as idle:
+                eventlet.sleep(0.02)
+        finally:
+            cputime.clock.release()
+
+        assert busy.cpu_ms == pytest.approx(busy.wall_ms, rel=0.5)
+        assert idle.cpu_ms < idle.wall_ms / 2
+
+
+class TestLazyClientDualTimer(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.fixture
+    def pipe(self, stats_client_cls):
+        pipeline = stats_client_cls.return_value.pipeline
+        return pipeline.return_value.__enter__.return_value
+
+    def test_enabled(self, stats_config, pipe):
+        lc = LazyClient(**stats_config['STATSD']['test'])
+
+        with lc.dual_timer('stat', rate=2) as timer:
+            pass
+
+        assert isinstance(timer, DualTimer)
+        assert [c[0][0] for c in pipe._send_stat.call_args_list] == [
+            'stat.wall', 'stat.cpu'
+        ]
+
+    def test_disabled(self, stats_config):
+        lc = LazyClient(**stats_config['STATSD']['test-disabled'])
+
+        with lc.dual_timer('stat') as timer:
+            pass
+
+        assert isinstance(timer, MagicMock)
+        assert lc.client.pipeline.call_args_list == []
+
+    def test_rate_override(self, stats_config):
+        lc = LazyClient(**stats_config['STATSD']['test'])
+        lc.reconfigure(rates={'db.': 0.1})
+
+        assert lc.dual_timer('db.query', 0.5).rate == 0.1
+        assert lc.dual_timer('http.get', 0.5).rate == 0.5
+
+
+class TestLazyClientTimings(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.fixture
+    def lazy_client(self, stats_config):
+        return LazyClient(**stats_config['STATSD']['test'])
+
+    @pytest.fixture
+    def pipe(self, stats_client_cls):
+        pipeline = stats_client_cls.return_value.pipeline
+        return pipeline.return_value.__enter__.return_value
+
+    def test_single_packet(self, lazy_client, pipe):
+        lazy_client.timings([('a', 1.5), ('b', 2)])
+
+        assert lazy_client.client.pipeline.call_count == 1
+        assert pipe._send_stat.call_args_list == [
+            call('a', '1.500000|ms', 1), call('b', '2.000000|ms', 1),
+        ]
+
+    @pytest.mark.parametrize('random, sent', [(0.4, True), (0.6, False)])
+    def test_sampled_together(self, lazy_client, pipe, random, sent):
+        with patch('random.random', return_value=random) as rand:
+            lazy_client.timings([('a', 1.5), ('b', 2)], 0.5)
+
+        # a single sampling decision for all the timings
+        assert rand.call_count == 1
+        assert pipe._send_stat.call_args_list == ([
+            call('a', '1.500000|ms|@0.5', 1),
+            call('b', '2.000000|ms|@0.5', 1),
+        ] if sent else [])
+
+    def test_disabled(self, lazy_client):
+        lazy_client.reconfigure(enabled=False)
+
+        lazy_client.timings([('a', 1.5)])
+
+        assert lazy_client.client.pipeline.call_args_list == []
+
+
+class DualTimerService(object):
+
+    name = 'dual_timer_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    @statsd.dual_timer('method', rate=3)
+    def method(self, value):
+        return value
+
+    @dummy
+    def clock_thread(self):
+        return cputime.clock.thread_id
+
+
+class ContextManagerService(object):
+
+    name = 'context_manager_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    def clock_thread(self):
+        with self.statsd.dual_timer('method'):
+            return cputime.clock.thread_id
+
+
+class TestStatsDDualTimer(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    def test_decorator(
+        self, container_factory, stats_config, stats_client_cls
+    ):
+        container = container_factory(DualTimerService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'method') as method:
+            assert method('value') == 'value'
+
+        pipeline = stats_client_cls.return_value.pipeline
+        pipe = pipeline.return_value.__enter__.return_value
+        assert [c[0][0] for c in pipe._send_stat.call_args_list] == [
+            'method.wall', 'method.cpu'
+        ]
+
+    def test_clock_installed_while_running(
+        self, container_factory, stats_config
+    ):
+        container = container_factory(DualTimerService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'clock_thread') as clock_thread:
+            # the hub thread, the one the container runs in
+            assert clock_thread() == cputime._get_ident()
+
+        container.stop()
+        assert cputime.clock.thread_id is None
+
+    @pytest.mark.parametrize('cpu_time, installed', [
+        (None, False), (True, True), (False, False),
+    ])
+    def test_context_manager_only(
+        self, container_factory, stats_config, cpu_time, installed
+    ):
+        if cpu_time is not None:
+            stats_config['STATSD']['test']['cpu_time'] = cpu_time
+
+        container = container_factory(ContextManagerService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'clock_thread') as clock_thread:
+            assert (clock_thread() is not None) is installed
+
+        statsd = next(iter(container.dependencies))
+        assert 'cpu_time' not in statsd.config
+
+    def test_decorator_opt_out(self, container_factory, stats_config):
+        stats_config['STATSD']['test']['cpu_time'] = False
+
+        container = container_factory(DualTimerService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'clock_thread') as clock_thread:
+            assert clock_thread() is None
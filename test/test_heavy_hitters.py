@@ -0,0 +1,288 @@
+import logging
+import random
+
+import eventlet
+from mock import MagicMock, call, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+
+from nameko_statsd.heavy_hitters import HeavyHitters, SpaceSaving
+from nameko_statsd.statsd_dep import LazyClient, StatsD
+
+
+class TestSpaceSaving(object):
+
+    def test_exact_below_capacity(self):
+        sketch = SpaceSaving(3)
+
+        for key in 'abacab':
+            sketch.add(key)
+        sketch.add('c', 5)
+
+        assert sketch.top(2) == [('c', 6, 0), ('a', 3, 0)]
+
+    def test_eviction(self):
+        sketch = SpaceSaving(2)
+
+        sketch.add('a', 5)
+        sketch.add('b', 2)
+        sketch.add('c')
+
+        # "c" replaces "b" and inherits its weight as error
+        assert sketch.top(3) == [('a', 5, 0), ('c', 3, 2)]
+
+    def test_fixed_memory_heavy_keys_found(self):
+        sketch = SpaceSaving(20)
+        rng = random.Random(42)
+
+        for i in range(20000):
+            if i % 4 == 0:
+                sketch.add('hot')
+            elif i % 10 == 1:
+                sketch.add('warm')
+            else:
+                sketch.add('user.{}'.format(rng.randrange(100000)))
+
+        assert len(sketch.counters) == 20
+        assert len(sketch._heap) <= 40
+        (first, weight, error), (second, _, _) = sketch.top(2)
+        assert (first, second) == ('hot', 'warm')
+        assert weight - error <= 5000 <= weight
+
+    def test_matches_linear_scan(self):
+        # the heap evicts the same keys as a scan for the lightest key
+        sketch = SpaceSaving(5)
+        reference = {}
+        rng = random.Random(7)
+
+        for _ in range(2000):
+            key = 'k{}'.format(rng.randrange(30))
+            weight = rng.choice([1, 2, 0.5])
+            sketch.add(key, weight)
+
+            if key in reference:
+                reference[key][0] += weight
+            elif len(reference) < 5:
+                reference[key] = [weight, 0]
+            else:
+                lightest = min(reference, key=lambda k: reference[k][0])
+                floor = reference.pop(lightest)[0]
+                reference[key] = [floor + weight, floor]
+
+            assert sorted(w for w, _ in sketch.counters.values()) == sorted(
+                w for w, _ in reference.values()
+            )
+
+
+class TestHeavyHitters(object):
+
+    @pytest.fixture
+    def client(self):
+        return MagicMock()
+
+    @pytest.fixture
+    def heavy_hitters(self, client):
+        return HeavyHitters(client, capacity=10, top=2, interval=0.01)
+
+    def test_observe_and_top(self, heavy_hitters):
+        heavy_hitters.observe_stat('a')
+        heavy_hitters.observe_stat('a')
+        heavy_hitters.observe_stat('b')
+        heavy_hitters.observe_call('m', 100.0)
+        heavy_hitters.observe_call('m', 50.0)
+        heavy_hitters.observe_call('n', 10.0)
+
+        # stat names and methods are tracked separately
+        assert heavy_hitters.top() == [('a', 2, 0), ('b', 1, 0)]
+        assert heavy_hitters.top(by='calls') == [('m', 2, 0), ('n', 1, 0)]
+        assert heavy_hitters.top(1, by='time') == [('m', 150.0, 0)]
+
+    def test_top_invalid_order(self, heavy_hitters):
+        with pytest.raises(ValueError) as err:
+            heavy_hitters.top(by='size')
+
+        assert err.match('Invalid heavy hitters order: size')
+
+    @patch('nameko_statsd.heavy_hitters.perf_counter', side_effect=[1, 1.25])
+    def test_timed(self, perf_counter, heavy_hitters):
+        with heavy_hitters.timed('method'):
+            pass
+
+        assert heavy_hitters.top(by='time') == [('method', 250.0, 0)]
+
+    def test_report(self, heavy_hitters, client, caplog):
+        for key in 'aabbbc':
+            heavy_hitters.observe_stat(key)
+        heavy_hitters.observe_call('m', 12.4)
+
+        with caplog.at_level(logging.INFO):
+            heavy_hitters.report()
+
+        assert client.incr_many.call_args_list == [
+            call(
+                [
+                    'heavy_hitters.stats.top1',
+                    'heavy_hitters.stats.top2',
+                    'heavy_hitters.calls.top1',
+                    'heavy_hitters.time.top1',
+                ],
+                [3, 2, 1, 12],
+            )
+        ]
+        assert heavy_hitters.top() == []
+        assert heavy_hitters.top(by='time') == []
+        assert heavy_hitters.last_report == {
+            'stats': [('b', 3, 0), ('a', 2, 0)],
+            'calls': [('m', 1, 0)],
+            'time': [('m', 12.4, 0)],
+        }
+        assert caplog.messages == [
+            'Heavy hitters by stats: b (3), a (2)',
+            'Heavy hitters by calls: m (1)',
+            'Heavy hitters by time: m (12.4)',
+        ]
+
+    def test_report_names_bounded(self, heavy_hitters, client):
+        names = set()
+        for interval in range(5):
+            for user in range(20):
+                heavy_hitters.observe_stat('user.{}.{}'.format(interval, user))
+            heavy_hitters.report()
+            (sent, _), _ = client.incr_many.call_args
+            names.update(sent)
+
+        # the same names, whatever the keys
+        assert names == {
+            'heavy_hitters.stats.top{}'.format(rank) for rank in range(1, 3)
+        }
+
+    def test_report_nothing(self, heavy_hitters, client):
+        heavy_hitters.report()
+
+        assert client.incr_many.call_args_list == []
+
+    def test_run(self, heavy_hitters, client):
+        heavy_hitters.observe_stat('a')
+
+        gt = eventlet.spawn(heavy_hitters.run)
+        eventlet.sleep(0.015)
+        heavy_hitters.stop()
+        gt.wait()
+
+        assert client.incr_many.call_args_list == [
+            call(['heavy_hitters.stats.top1'], [1])
+        ]
+
+
+class TestLazyClientHeavyHitters(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    def test_every_stat_observed(self, stats_config):
+        lc = LazyClient(**stats_config['STATSD']['test'])
+        lc.heavy_hitters = HeavyHitters(MagicMock())
+
+        lc.incr('a')
+        lc.gauge('a', 1)
+        lc.timer('b')
+        lc.incr_many(['a', 'c'])
+        lc.timing_many('d', [1, 2])
+        with lc.pipeline() as pipe:
+            pipe.incr('c')
+            with pipe.pipeline() as nested:
+                nested.set('d', 'user')
+                nested.incr('d')
+        lc.timings([('d', 1)])
+
+        assert lc.heavy_hitters.top() == [
+            ('d', 5, 0), ('a', 3, 0), ('c', 2, 0), ('b', 1, 0),
+        ]
+
+
+class HeavyHittersService(object):
+
+    name = 'heavy_hitters_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    @statsd.timer('method')
+    def method(self):
+        self.statsd.incr('hit')
+
+    @dummy
+    def top(self):
+        if self.statsd.heavy_hitters is not None:
+            return self.statsd.heavy_hitters.top()
+
+
+class TestStatsDHeavyHitters(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    def test_tracking(self, container_factory, stats_config):
+        stats_config['STATSD']['test']['heavy_hitters'] = {'interval': 10}
+
+        container = container_factory(HeavyHittersService, stats_config)
+        container.start()
+
+        for _ in range(3):
+            with entrypoint_hook(container, 'method') as method:
+                method()
+
+        with entrypoint_hook(container, 'top') as top:
+            assert top() == [('method', 3, 0), ('hit', 3, 0)]
+
+        statsd = next(iter(container.dependencies))
+        assert statsd.heavy_hitters.top(by='calls') == [
+            ('HeavyHittersService.method', 3, 0)
+        ]
+        (key, _, _), = statsd.heavy_hitters.top(by='time')
+        assert key == 'HeavyHittersService.method'
+        assert 'heavy_hitters' not in statsd.config
+
+        container.stop()
+        assert statsd.heavy_hitters._running is False
+
+    def test_report_guarded(
+        self, container_factory, stats_config, stats_client_cls
+    ):
+        stats_config['STATSD']['test']['heavy_hitters'] = True
+        stats_config['STATSD']['test']['cardinality'] = {'limit': 3}
+
+        container = container_factory(HeavyHittersService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'method') as method:
+            method()
+
+        statsd = next(iter(container.dependencies))
+        statsd.heavy_hitters.report()
+
+        pipeline = stats_client_cls.return_value.pipeline
+        pipe = pipeline.return_value.__enter__.return_value
+        sent = [c[0][0] for c in pipe.incr.call_args_list]
+        # "method" and "hit" were admitted first, so only one more name
+        assert sent == [
+            'heavy_hitters.calls.top1',
+            'cardinality.other',
+            'cardinality.other',
+            'cardinality.other',
+        ]
+        assert statsd.cardinality_guard.overflows == 3
+
+    def test_no_tracking(self, container_factory, stats_config):
+        container = container_factory(HeavyHittersService, stats_config)
+        container.start()
+
+        with entrypoint_hook(container, 'method') as method:
+            method()
+
+        with entrypoint_hook(container, 'top') as top:
+            assert top() is None
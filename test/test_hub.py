@@ -0,0 +1,184 @@
+import logging
+
+import eventlet
+from eventlet import patcher
+from mock import MagicMock, Mock, call, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+
+from nameko_statsd.hub import HubLagMonitor
+from nameko_statsd.statsd_dep import StatsD
+
+
+blocking_sleep = patcher.original('time').sleep
+
+
+class TestHubLagMonitor(object):
+
+    @pytest.fixture
+    def client(self):
+        return MagicMock()
+
+    @pytest.fixture
+    def monitor(self, client):
+        return HubLagMonitor(
+            client, interval=0.01, report_interval=0.05, threshold=0.1
+        )
+
+    def test_sample(self, monitor, client):
+        with patch('nameko_statsd.hub.monotonic', side_effect=[10, 10.03]):
+            now = monitor.sample()
+
+        assert now == 10.03
+        assert list(monitor.samples) == [pytest.approx(0.02)]
+        assert client.incr.call_args_list == []
+
+    def test_sample_blocked(self, monitor, client, caplog):
+        monitor._blocked_stack = 'the stack'
+
+        with patch('nameko_statsd.hub.monotonic', side_effect=[10, 10.51]):
+            with caplog.at_level(logging.WARNING):
+                monitor.sample()
+
+        assert client.incr.call_args_list == [call('hub_lag.blocked')]
+        assert caplog.messages == [
+            'Eventlet hub blocked for 0.500s.\nthe stack'
+        ]
+        assert monitor._blocked_stack is None
+
+    def test_sample_blocked_no_stack(self, monitor, client, caplog):
+        with patch('nameko_statsd.hub.monotonic', side_effect=[10, 10.51]):
+            with caplog.at_level(logging.WARNING):
+                monitor.sample()
+
+        assert client.incr.call_args_list == [call('hub_lag.blocked')]
+        assert caplog.messages == [
+            'Eventlet hub blocked for 0.500s. No stack was captured.'
+        ]
+
+    def test_report(self, monitor, client):
+        monitor.samples.extend([0.004, 0.001, 0.003, 0.002, 0.005])
+
+        monitor.report()
+
+        pipe = client.pipeline.return_value.__enter__.return_value
+        assert pipe.gauge.call_args_list == [
+            call('hub_lag.p50', 3.0),
+            call('hub_lag.p90', 5.0),
+            call('hub_lag.p99', 5.0),
+            call('hub_lag.max', 5.0),
+        ]
+        assert list(monitor.samples) == []
+
+    def test_report_no_samples(self, monitor, client):
+        monitor.report()
+
+        assert client.pipeline.call_args_list == []
+
+    def test_watch(self, monitor):
+        # run the watchdog loop once, in this thread, against a stale
+        # heartbeat
+        monitor._hub_thread_id = patcher.original('threading').get_ident()
+        monitor._heartbeat = 0
+        monitor._stopped = Mock()
+        monitor._stopped.wait.side_effect = [False, False, True]
+
+        monitor._watch()
+
+        assert 'test_watch' in monitor._blocked_stack
+        assert monitor._stopped.wait.call_args_list == [call(0.05)] * 3
+
+    def test_watch_not_blocked(self, monitor):
+        monitor._heartbeat = float('inf')
+        monitor._stopped = Mock()
+        monitor._stopped.wait.side_effect = [False, True]
+
+        monitor._watch()
+
+        assert monitor._blocked_stack is None
+
+    def test_run(self, monitor, client):
+        gt = eventlet.spawn(monitor.run)
+        eventlet.sleep(0.12)
+        monitor.stop()
+        gt.wait()
+
+        pipe = client.pipeline.return_value.__enter__.return_value
+        assert [args[0] for args, _ in pipe.gauge.call_args_list[:4]] == [
+            'hub_lag.p50', 'hub_lag.p90', 'hub_lag.p99', 'hub_lag.max',
+        ]
+        assert client.incr.call_args_list == []
+
+    def test_run_blocked(self, monitor, client, caplog):
+        gt = eventlet.spawn(monitor.run)
+        eventlet.sleep(0.02)
+
+        with caplog.at_level(logging.WARNING):
+            blocking_sleep(0.3)  # the hub can't run anything meanwhile
+            eventlet.sleep(0.02)
+
+        monitor.stop()
+        gt.wait()
+
+        assert client.incr.call_args_list == [call('hub_lag.blocked')]
+        assert len(caplog.messages) == 1
+        assert 'blocking_sleep(0.3)' in caplog.messages[0]
+        assert 'test_run_blocked' in caplog.messages[0]
+
+    def test_run_killed(self, monitor):
+        gt = eventlet.spawn(monitor.run)
+        eventlet.sleep(0.02)
+        gt.kill()
+
+        assert monitor._stopped.is_set()
+
+
+class HubLagService(object):
+
+    name = 'hub_lag_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    def method(self):
+        return 'ok'
+
+
+class TestStatsDHubLag(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.mark.parametrize('hub_lag', [
+        True, {'interval': 0.01, 'report_interval': 0.02},
+    ])
+    def test_monitor_lifecycle(
+        self, container_factory, stats_config, hub_lag
+    ):
+        stats_config['STATSD']['test']['hub_lag'] = hub_lag
+
+        container = container_factory(HubLagService, stats_config)
+        container.start()
+
+        statsd = next(iter(container.dependencies))
+        monitor = statsd.hub_lag_monitor
+        assert isinstance(monitor, HubLagMonitor)
+        assert 'hub_lag' not in statsd.config
+
+        with entrypoint_hook(container, 'method') as method:
+            assert method() == 'ok'
+
+        container.stop()
+
+        assert monitor._stopped.is_set()
+
+    def test_no_monitor(self, container_factory, stats_config):
+        container = container_factory(HubLagService, stats_config)
+        container.start()
+
+        statsd = next(iter(container.dependencies))
+        assert statsd.hub_lag_monitor is None
+
+        container.stop()
@@ -1,4 +1,5 @@
 from mock import Mock, call, patch
+import numpy
 import pytest
 
 from nameko_statsd.statsd_dep import LazyClient, Protocols
@@ -10,12 +11,12 @@ class TestLazyClient(object):
 
     @pytest.fixture(autouse=True)
     def stats_client_cls(self):
-        with patch('nameko_statsd.statsd_dep.StatsClient') as sc:
+        with patch('nameko_statsd.settings.StatsClient') as sc:
             yield sc
 
     @pytest.fixture(autouse=True)
     def stats_client_cls_tcp(self):
-        with patch('nameko_statsd.statsd_dep.TCPStatsClient') as sc:
+        with patch('nameko_statsd.settings.TCPStatsClient') as sc:
             yield sc
 
 
@@ -215,7 +216,9 @@ class TestStatMethods(TestLazyClient):
             pipe.incr('foo')
             pipe.send()
 
-        assert pipe is lc.client.pipeline.return_value.__enter__.return_value
+        assert pipe._pipeline is (
+            lc.client.pipeline.return_value.__enter__.return_value
+        )
         assert lc.client.pipeline.mock_calls == [
             call(),
             call().__enter__(),
@@ -236,3 +239,96 @@ class TestStatMethods(TestLazyClient):
 
         assert isinstance(pipe, Mock)
         assert lc.client.pipeline.mock_calls == []
+
+
+class TestBulkMethods(TestLazyClient):
+
+    @pytest.fixture(params=['test', 'test-tcp'])
+    def stats_config(self, request, stats_config):
+        return stats_config['STATSD'][request.param].copy()
+
+    @pytest.fixture
+    def pipe(self, stats_config):
+        lc = LazyClient(**stats_config)
+        return lc.client.pipeline.return_value.__enter__.return_value
+
+    def test_incr_many(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.incr_many(['a', 'b', 'a'], [1, 2, 3])
+        lc.incr_many('c', numpy.array([1, 2, 3]))
+
+        assert lc.client.pipeline.call_count == 2
+        assert pipe.incr.call_args_list == [
+            call('a', 4), call('b', 2), call('c', 6),
+        ]
+
+    def test_incr_many_default_counts(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.incr_many(name for name in ['a', 'b', 'a'])
+
+        assert pipe.incr.call_args_list == [call('a', 2), call('b', 1)]
+
+    def test_incr_many_single_name_default_count(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.incr_many('processed')
+
+        assert pipe.incr.call_args_list == [call('processed', 1)]
+
+    def test_incr_many_length_mismatch(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        with pytest.raises(ValueError) as err:
+            lc.incr_many(['a', 'b', 'c'], [1, 2])
+
+        assert err.match('Got 3 stat names for 2 values')
+        assert pipe.incr.call_args_list == []
+
+    def test_timing_many(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.timing_many(['t', 'u', 't'], numpy.array([3.0, 1.5, 2.0]))
+
+        assert lc.client.pipeline.call_count == 1
+        assert pipe.timing.call_args_list == [
+            call('t', 3.0), call('t', 2.0), call('u', 1.5),
+        ]
+        assert pipe.gauge.call_args_list == []
+
+    def test_timing_many_aggregate(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.timing_many(
+            't', numpy.array([3.0, 1.0, 2.0]), percentiles=(50,),
+            aggregate=True,
+        )
+
+        assert lc.client.pipeline.call_count == 1
+        assert pipe.incr.call_args_list == [call('t.count', 3)]
+        assert pipe.gauge.call_args_list == [
+            call('t.mean', 2.0),
+            call('t.min', 1.0),
+            call('t.max', 3.0),
+            call('t.p50', 2.0),
+        ]
+
+    def test_gauge_many(self, stats_config, pipe):
+        lc = LazyClient(**stats_config)
+
+        lc.gauge_many(['a', 'b', 'a'], [1, 2, 3])
+
+        assert lc.client.pipeline.call_count == 1
+        assert pipe.gauge.call_args_list == [call('a', 3), call('b', 2)]
+
+    @pytest.mark.parametrize('method', [
+        'incr_many', 'timing_many', 'gauge_many',
+    ])
+    def test_disabled(self, method, stats_config):
+        stats_config['enabled'] = False
+        lc = LazyClient(**stats_config)
+
+        getattr(lc, method)('a', [1, 2, 3])
+
+        assert lc.client.pipeline.call_args_list == []
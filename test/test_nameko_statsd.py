@@ -5,6 +5,7 @@ import pytest
 from nameko.testing.services import dummy, entrypoint_hook, worker_factory
 from nameko.rpc import rpc
 
+from nameko_statsd.settings import Protocols
 from nameko_statsd.statsd_dep import StatsD
 from nameko_statsd.bases import ServiceBase
 
@@ -29,14 +30,15 @@ class TestStatsD(object):
         dep = statsd.get_dependency(worker_ctx)
 
         assert lazy_client_cls.call_args_list == [
-            call(
-                host='statsd.host',
-                port=1234,
-                prefix='statsd.prefix',
-                maxudpsize=1024,
-                enabled=True,
-            )
+            call(settings=statsd.settings)
         ]
+        assert statsd.settings.current.enabled is True
+        assert statsd.settings.current.config == {
+            'host': 'statsd.host',
+            'port': 1234,
+            'prefix': 'statsd.prefix',
+            'maxudpsize': 1024,
+        }
         assert dep == lazy_client_cls.return_value
 
     def test_get_dependency_tcp(self, lazy_client_cls, stats_config):
@@ -50,15 +52,15 @@ class TestStatsD(object):
         dep = statsd.get_dependency(worker_ctx)
 
         assert lazy_client_cls.call_args_list == [
-            call(
-                host='tcp.statsd.host',
-                port=4321,
-                prefix='tcp.statsd.prefix',
-                timeout=5,
-                enabled=True,
-                protocol='tcp'
-            )
+            call(settings=statsd.settings)
         ]
+        assert statsd.settings.current.protocol is Protocols.tcp
+        assert statsd.settings.current.config == {
+            'host': 'tcp.statsd.host',
+            'port': 4321,
+            'prefix': 'tcp.statsd.prefix',
+            'timeout': 5,
+        }
         assert dep == lazy_client_cls.return_value
 
     def test_name_argument_deprecated(self, recwarn):
@@ -201,12 +203,12 @@ class TestTimer(object):
 
     @pytest.fixture(autouse=True)
     def stats_client_cls(self):
-        with patch('nameko_statsd.statsd_dep.StatsClient') as sc:
+        with patch('nameko_statsd.settings.StatsClient') as sc:
             yield sc
 
     @pytest.fixture(autouse=True)
     def stats_client_cls_tcp(self):
-        with patch('nameko_statsd.statsd_dep.TCPStatsClient') as sc:
+        with patch('nameko_statsd.settings.TCPStatsClient') as sc:
             yield sc
 
     def test_enabled(self, container_factory, config, stats_client_cls):
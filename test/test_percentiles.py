@@ -0,0 +1,17 @@
+import pytest
+
+from nameko_statsd.percentiles import percentile, rank
+
+
+@pytest.mark.parametrize('pct, expected', [
+    (0, 1), (20, 1), (21, 2), (50, 3), (90, 5), (99, 5), (100, 5),
+])
+def test_percentile(pct, expected):
+    assert percentile([1, 2, 3, 4, 5], pct) == expected
+
+
+@pytest.mark.parametrize('count, pct, expected', [
+    (10, 70, 6), (10, 71, 7), (1000, 99, 989), (1000, 99.9, 998), (1, 0, 0),
+])
+def test_rank(count, pct, expected):
+    assert rank(count, pct) == expected
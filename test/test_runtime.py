@@ -0,0 +1,173 @@
+import gc
+import os
+
+import eventlet
+from mock import MagicMock, Mock, call, patch
+import pytest
+from nameko.testing.services import dummy
+
+from nameko_statsd.runtime import RuntimeCollector, open_fds, rss
+from nameko_statsd.statsd_dep import StatsD
+
+
+def test_rss():
+    assert rss() > 0
+
+
+def test_rss_unavailable():
+    with patch('nameko_statsd.runtime.open', side_effect=IOError, create=True):
+        assert rss() is None
+
+
+def test_open_fds():
+    before = open_fds()
+
+    with open(__file__):
+        assert open_fds() == before + 1
+
+
+def test_open_fds_unavailable():
+    with patch('nameko_statsd.runtime.os.listdir', side_effect=OSError):
+        assert open_fds() is None
+
+
+class TestRuntimeCollector(object):
+
+    @pytest.fixture
+    def client(self):
+        return MagicMock()
+
+    @pytest.fixture
+    def container(self):
+        container = Mock()
+        container._worker_threads = {1: 'worker', 2: 'worker'}
+        container._managed_threads = {3: 'managed'}
+        return container
+
+    @pytest.fixture
+    def collector(self, client, container):
+        return RuntimeCollector(client, container=container, interval=0.01)
+
+    @pytest.fixture
+    def pipe(self, client):
+        return client.pipeline.return_value.__enter__.return_value
+
+    @pytest.fixture
+    def times(self):
+        with patch('nameko_statsd.runtime.os.times') as times:
+            times.side_effect = [
+                os.times_result((1.0, 2.0, 0, 0, 100)),
+                os.times_result((1.5, 2.25, 0, 0, 101)),
+            ]
+            yield times
+
+    @patch('nameko_statsd.runtime.open_fds', Mock(return_value=12))
+    @patch('nameko_statsd.runtime.rss', Mock(return_value=4096))
+    def test_report(self, collector, client, pipe, times):
+        collector._cpu_times = os.times()
+        collector._gc_collections = [3, 2, 1]
+        collector._gc_pause = [0.001, 0.002, 0.5]
+
+        collector.report()
+
+        assert client.pipeline.call_count == 1
+        assert pipe.gauge.call_args_list == [
+            call('runtime.rss', 4096),
+            call('runtime.fds', 12),
+            call('runtime.greenthreads.workers', 2),
+            call('runtime.greenthreads.managed', 1),
+        ]
+        assert pipe.incr.call_args_list == [
+            call('runtime.gc.gen0.collections', 3),
+            call('runtime.gc.gen0.pause', 1.0),
+            call('runtime.gc.gen1.collections', 2),
+            call('runtime.gc.gen1.pause', 2.0),
+            call('runtime.gc.gen2.collections', 1),
+            call('runtime.gc.gen2.pause', 500.0),
+            call('runtime.cpu.user', 500.0),
+            call('runtime.cpu.system', 250.0),
+        ]
+        assert collector._gc_collections == [0, 0, 0]
+        assert collector._gc_pause == [0.0, 0.0, 0.0]
+
+    @patch('nameko_statsd.runtime.open_fds', Mock(return_value=None))
+    @patch('nameko_statsd.runtime.rss', Mock(return_value=None))
+    def test_report_unavailable(self, client, pipe):
+        collector = RuntimeCollector(client, stat='rt')
+        collector._cpu_times = os.times()
+
+        collector.report()
+
+        assert pipe.gauge.call_args_list == []
+        assert [args[0] for args, _ in pipe.incr.call_args_list] == [
+            'rt.gc.gen0.collections', 'rt.gc.gen0.pause',
+            'rt.gc.gen1.collections', 'rt.gc.gen1.pause',
+            'rt.gc.gen2.collections', 'rt.gc.gen2.pause',
+            'rt.cpu.user', 'rt.cpu.system',
+        ]
+
+    def test_gc_callback(self, collector):
+        with patch('nameko_statsd.runtime.perf_counter') as perf_counter:
+            perf_counter.side_effect = [10.0, 10.25]
+            collector._gc_callback('start', {'generation': 1})
+            collector._gc_callback('stop', {'generation': 1})
+
+        # a "stop" without a "start" (registered during a collection)
+        collector._gc_callback('stop', {'generation': 2})
+
+        assert collector._gc_collections == [0, 1, 0]
+        assert collector._gc_pause == [0.0, 0.25, 0.0]
+
+    def test_run(self, collector, pipe):
+        gt = eventlet.spawn(collector.run)
+        eventlet.sleep(0)
+        assert collector._gc_callback in gc.callbacks
+
+        gc.collect()
+        eventlet.sleep(0.015)
+        collector.stop()
+        gt.wait()
+
+        assert collector._gc_callback not in gc.callbacks
+        assert call('runtime.gc.gen2.collections', 1) in (
+            pipe.incr.call_args_list
+        )
+
+
+class RuntimeService(object):
+
+    name = 'runtime_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    def method(self):
+        pass
+
+
+class TestStatsDRuntime(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    def test_collector_lifecycle(self, container_factory, stats_config):
+        stats_config['STATSD']['test']['runtime_metrics'] = {
+            'interval': 0.01
+        }
+        stats_config['STATSD']['test']['hub_lag'] = True
+
+        container = container_factory(RuntimeService, stats_config)
+        container.start()
+
+        statsd = next(iter(container.dependencies))
+        collector = statsd.runtime_collector
+        assert isinstance(collector, RuntimeCollector)
+        assert collector.container is statsd.container
+        assert 'runtime_metrics' not in statsd.config
+
+        eventlet.sleep(0.015)
+        container.stop()
+
+        assert collector._gc_callback not in gc.callbacks
@@ -0,0 +1,366 @@
+import socket
+
+import eventlet
+from mock import call, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+from statsd import StatsClient, TCPStatsClient
+
+from nameko_statsd.settings import (
+    Protocols, Settings, SharedSettings, get_protocol, sort_rates
+)
+from nameko_statsd.statsd_dep import LazyClient, StatsD
+
+
+@pytest.mark.parametrize('protocol, expected', [
+    ('udp', Protocols.udp), ('TCP', Protocols.tcp),
+])
+def test_get_protocol(protocol, expected):
+    assert get_protocol(protocol) is expected
+
+
+def test_get_protocol_invalid():
+    with pytest.raises(ValueError) as err:
+        get_protocol('upd')
+
+    assert err.match('Invalid protocol: upd')
+
+
+def test_sort_rates():
+    assert sort_rates({'a': 0.5, 'a.b.c': 0.1, 'a.b': 0.2}) == (
+        ('a.b.c', 0.1), ('a.b', 0.2), ('a', 0.5),
+    )
+
+
+@pytest.mark.parametrize('stat, expected', [
+    ('db.query', 0.1),
+    ('db.query.slow', 0.5),
+    ('dbx', None),
+    ('http', None),
+])
+def test_settings_rate(stat, expected):
+    settings = Settings(
+        True, Protocols.udp, {},
+        sort_rates({'db.': 0.1, 'db.query.slow': 0.5}),
+    )
+
+    assert settings.rate(stat) == expected
+
+
+class TestSharedSettings(object):
+
+    @pytest.fixture
+    def shared(self):
+        return SharedSettings.from_config({
+            'enabled': True,
+            'host': 'localhost',
+            'port': 1234,
+            'rates': {'db': 0.1},
+        })
+
+    def test_from_config(self, shared):
+        assert shared.current == Settings(
+            True, Protocols.udp, {'host': 'localhost', 'port': 1234},
+            (('db', 0.1),),
+        )
+
+    def test_reconfigure_enabled(self, shared):
+        before = shared.current
+
+        after = shared.reconfigure(enabled=False)
+
+        assert shared.current is after
+        assert after == before._replace(enabled=False)
+        assert after.config is before.config
+
+    def test_reconfigure_rates(self, shared):
+        assert shared.reconfigure(rates={'http': 0.5}).rates == (
+            ('http', 0.5),
+        )
+        assert shared.reconfigure(rates={}).rates == ()
+
+    def test_reconfigure_target(self, shared):
+        before = shared.current
+
+        after = shared.reconfigure(host='other.host', protocol='tcp')
+
+        assert after.protocol is Protocols.tcp
+        assert after.config == {'host': 'other.host', 'port': 1234}
+        assert before.config == {'host': 'localhost', 'port': 1234}
+
+    def test_reconfigure_protocol_only(self, shared):
+        before = shared.current
+
+        after = shared.reconfigure(protocol='tcp')
+
+        assert after.config == before.config
+        assert after.config is not before.config
+
+    def test_reconfigure_buffered(self, shared):
+        before = shared.current
+        assert before.buffered is False
+
+        after = shared.reconfigure(buffered=True)
+
+        assert after.buffered is True
+        assert after.config == before.config
+        assert after.config is not before.config
+
+    def test_reconfigure_nothing(self, shared):
+        before = shared.current
+
+        assert shared.reconfigure() == before
+
+    @pytest.mark.parametrize('config, protocol, expected', [
+        (
+            {'protocol': 'udp', 'maxudpsize': 1024, 'ipv6': False}, 'tcp',
+            {'host': 'localhost', 'port': 1234, 'ipv6': False},
+        ),
+        (
+            {'protocol': 'tcp', 'timeout': 2, 'prefix': 'p'}, 'udp',
+            {'host': 'localhost', 'port': 1234, 'prefix': 'p'},
+        ),
+        (
+            {'protocol': 'udp', 'maxudpsize': 1024}, 'udp',
+            {'host': 'localhost', 'port': 1234, 'maxudpsize': 1024},
+        ),
+    ])
+    def test_reconfigure_protocol_arguments(self, config, protocol, expected):
+        shared = SharedSettings.from_config(
+            dict(config, enabled=True, host='localhost', port=1234)
+        )
+        lazy_client = LazyClient(settings=shared)
+
+        shared.reconfigure(protocol=protocol)
+
+        assert shared.current.config == expected
+        # the real statsd clients accept the remaining arguments
+        assert isinstance(
+            lazy_client.client,
+            StatsClient if protocol == 'udp' else TCPStatsClient
+        )
+
+    def test_reconfigure_protocol_and_arguments(self, shared):
+        after = shared.reconfigure(protocol='tcp', timeout=3)
+
+        assert after.config == {
+            'host': 'localhost', 'port': 1234, 'timeout': 3,
+        }
+        assert isinstance(after.make_client(), TCPStatsClient)
+
+    @pytest.mark.parametrize('changes, error', [
+        ({'maxudpsize': 1024, 'protocol': 'tcp'}, TypeError),
+        ({'timeout': 3}, TypeError),
+        ({'port': 'no-such-service'}, socket.gaierror),
+    ])
+    def test_reconfigure_invalid_target(self, shared, changes, error):
+        before = shared.current
+
+        with pytest.raises(error):
+            shared.reconfigure(**changes)
+
+        assert shared.current is before
+
+
+class TestLazyClientReconfigure(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls_tcp(self):
+        with patch('nameko_statsd.settings.TCPStatsClient') as sc:
+            yield sc
+
+    @pytest.fixture
+    def lazy_client(self, stats_config):
+        return LazyClient(**stats_config['STATSD']['test'])
+
+    def test_enabled(self, lazy_client):
+        lazy_client.reconfigure(enabled=False)
+        lazy_client.incr('foo')
+
+        lazy_client.reconfigure(enabled=True)
+        lazy_client.incr('bar')
+
+        assert lazy_client.client.incr.call_args_list == [call('bar')]
+
+    @pytest.mark.parametrize('method, args, kwargs, expected', [
+        ('incr', ('db.query',), {}, call('db.query', rate=0.1)),
+        ('incr', ('db.query', 2, 0.5), {}, call('db.query', 2, 0.1)),
+        ('incr', ('db.query', 2), {'rate': 1}, call('db.query', 2, rate=0.1)),
+        ('gauge', ('db.size', 3, 1, True), {}, call('db.size', 3, 0.1, True)),
+        ('timing', ('db.query', 12), {}, call('db.query', 12, rate=0.1)),
+        ('timer', ('db.query', 1), {}, call('db.query', 0.1)),
+        ('timer', ('http.get',), {'rate': 0.5}, call('http.get', rate=0.5)),
+    ])
+    def test_rates(self, lazy_client, method, args, kwargs, expected):
+        lazy_client.reconfigure(rates={'db.': 0.1})
+
+        getattr(lazy_client, method)(*args, **kwargs)
+
+        assert getattr(lazy_client.client, method).call_args_list == [
+            expected
+        ]
+
+    def test_rates_from_config(self, stats_config):
+        config = dict(stats_config['STATSD']['test'], rates={'db': 0.2})
+        lazy_client = LazyClient(**config)
+
+        lazy_client.decr('db.connections')
+
+        assert 'rates' not in lazy_client.config
+        assert lazy_client.client.decr.call_args_list == [
+            call('db.connections', rate=0.2)
+        ]
+
+    def test_rates_bulk_methods(self, lazy_client):
+        pipeline = lazy_client.client.pipeline.return_value
+        pipe = pipeline.__enter__.return_value
+        lazy_client.reconfigure(rates={'db.': 0.1})
+
+        lazy_client.incr_many(['db.query', 'http.get', 'db.query'])
+        lazy_client.gauge_many('db.size', [3])
+        lazy_client.timing_many('db.query', [12.0])
+
+        assert pipe.incr.call_args_list == [
+            call('db.query', 2, rate=0.1), call('http.get', 1),
+        ]
+        assert pipe.gauge.call_args_list == [call('db.size', 3, rate=0.1)]
+        assert pipe.timing.call_args_list == [
+            call('db.query', 12.0, rate=0.1)
+        ]
+        assert pipeline.__exit__.call_count == 3
+
+    def test_rates_pipeline(self, lazy_client):
+        pipeline = lazy_client.client.pipeline.return_value
+        pipe = pipeline.__enter__.return_value
+        nested = pipe.pipeline.return_value.__enter__.return_value
+        lazy_client.reconfigure(rates={'db.': 0.1})
+
+        with lazy_client.pipeline() as rated:
+            rated.incr('db.query', 2, 0.5)
+            rated.set('http.user', 'joe')
+            rated.timer('db.query')
+            with rated.pipeline() as rated_nested:
+                rated_nested.decr('db.connections')
+
+        assert pipe.incr.call_args_list == [call('db.query', 2, 0.1)]
+        assert pipe.set.call_args_list == [call('http.user', 'joe')]
+        assert pipe.timer.call_args_list == [call('db.query', rate=0.1)]
+        assert nested.decr.call_args_list == [
+            call('db.connections', rate=0.1)
+        ]
+        assert pipeline.__exit__.call_count == 1
+        assert pipe.pipeline.return_value.__exit__.call_count == 1
+
+        # the other attributes are the ones of the pipeline
+        rated.send()
+        assert pipe.send.call_count == 1
+
+    def test_pipeline_without_rates(self, lazy_client):
+        pipe = lazy_client.client.pipeline.return_value
+
+        lazy_client.pipeline().incr('db.query', 2, 0.5)
+
+        assert pipe.incr.call_args_list == [call('db.query', 2, 0.5)]
+
+    def test_shared_settings(self, lazy_client):
+        other = LazyClient(settings=lazy_client.settings)
+
+        lazy_client.reconfigure(enabled=False)
+
+        assert other.settings is lazy_client.settings
+        assert other.enabled is False
+
+    def test_target(
+        self, lazy_client, stats_client_cls, stats_client_cls_tcp
+    ):
+        client = lazy_client.client
+        assert lazy_client.client is client
+
+        lazy_client.reconfigure(host='tcp.host', port=8125, protocol='tcp')
+
+        assert lazy_client.protocol is Protocols.tcp
+        assert lazy_client.client is stats_client_cls_tcp.return_value
+        # created once to check the target, then by the client
+        assert stats_client_cls_tcp.call_args_list == [
+            call(host='tcp.host', port=8125, prefix='statsd.prefix'),
+        ] * 2
+
+
+class ReconfigureService(object):
+
+    name = 'reconfigure_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    @statsd.timer('method')
+    def method(self, started=None, wait=None):
+        self.statsd.incr('before')
+        if wait is not None:
+            started.send()
+            wait.wait()
+        self.statsd.incr('after')
+
+    @dummy
+    def disable(self):
+        self.statsd.reconfigure(enabled=False)
+
+
+class TestStatsDReconfigure(object):
+
+    @pytest.fixture(autouse=True)
+    def stats_client_cls(self):
+        with patch('nameko_statsd.settings.StatsClient') as sc:
+            yield sc
+
+    @pytest.fixture
+    def container(self, container_factory, stats_config):
+        container = container_factory(ReconfigureService, stats_config)
+        container.start()
+        return container
+
+    def test_in_flight_workers(self, container, stats_client_cls):
+        statsd = next(iter(container.dependencies))
+        started, wait = eventlet.Event(), eventlet.Event()
+
+        with entrypoint_hook(container, 'method') as method:
+            gt = eventlet.spawn(method, started, wait)
+            started.wait()
+
+            statsd.reconfigure(enabled=False)
+            wait.send()
+            gt.wait()
+
+        client = stats_client_cls.return_value
+        assert client.incr.call_args_list == [call('before')]
+
+        with entrypoint_hook(container, 'method') as method:
+            method()
+
+        assert client.incr.call_args_list == [call('before')]
+
+    def test_from_worker(self, container, stats_client_cls):
+        with entrypoint_hook(container, 'disable') as disable:
+            disable()
+
+        with entrypoint_hook(container, 'method') as method:
+            method()
+
+        client = stats_client_cls.return_value
+        assert client.incr.call_args_list == []
+        assert client.timer.call_args_list == []
+
+    def test_background_clients(self, container_factory, stats_config):
+        stats_config['STATSD']['test']['runtime_metrics'] = True
+        container = container_factory(ReconfigureService, stats_config)
+
+        statsd = next(iter(container.dependencies))
+        statsd.setup()
+        statsd.reconfigure(enabled=False)
+
+        assert statsd.runtime_collector.client.enabled is False
@@ -0,0 +1,428 @@
+import socket
+from datetime import timedelta
+from decimal import Decimal
+
+from mock import Mock, patch
+import pytest
+from nameko.testing.services import dummy, entrypoint_hook
+from statsd import StatsClient
+
+from nameko_statsd.settings import Protocols
+from nameko_statsd.statsd_dep import LazyClient, StatsD
+from nameko_statsd.transport import (
+    BufferedStatsClient, PacketWriter, StatNames, format_value, rate_suffix
+)
+
+
+@pytest.mark.parametrize('value', [
+    3, -2, 300, True, 1.5, 0.1, 1e20, Decimal('1.10'), 'user',
+])
+def test_format_value(value):
+    assert format_value(value) == ('%s' % value).encode('ascii')
+
+
+def test_format_value_numpy():
+    numpy = pytest.importorskip('numpy')
+
+    for value in (numpy.int64(7), numpy.float32(0.1), numpy.float64(0.1)):
+        assert format_value(value) == ('%s' % value).encode('ascii')
+
+
+def test_small_ints_cached():
+    assert format_value(12) is format_value(12)
+
+
+def test_rate_suffix():
+    assert rate_suffix(0.25) == b'|@0.25'
+    assert rate_suffix(0.25) is rate_suffix(0.25)
+
+
+def test_rate_suffixes_bounded():
+    with patch('nameko_statsd.transport._RATES', {}) as rates:
+        with patch('nameko_statsd.transport._MAX_RATES', 2):
+            rate_suffix(0.1)
+            rate_suffix(0.2)
+            rate_suffix(0.3)
+
+    assert rates == {0.3: b'|@0.3'}
+
+
+class TestStatNames(object):
+
+    def test_cached(self):
+        names = StatNames('p')
+        name = names.get('stat')
+
+        assert name == b'p.stat:'
+        assert names.get('stat') is name
+
+    def test_no_prefix(self):
+        assert StatNames().get('stat') == b'stat:'
+
+    def test_bounded(self):
+        names = StatNames(max_names=2)
+
+        names.get('a')
+        names.get('b')
+        names.get('c')
+
+        assert names._names == {'c': b'c:'}
+
+
+class TestPacketWriter(object):
+
+    @pytest.fixture
+    def packets(self):
+        return []
+
+    @pytest.fixture
+    def writer(self, packets):
+        # the memoryview is only valid during the call, hence the copy
+        return PacketWriter(
+            lambda data: packets.append(bytes(data)), size=32,
+            names=StatNames('p'),
+        )
+
+    def test_write_and_flush(self, writer, packets):
+        writer.write('a', b'1', b'|c')
+        writer.write('b', b'2', b'|g', 0.5, plus=True)
+
+        assert packets == []
+
+        writer.flush()
+        writer.flush()
+
+        assert packets == [b'p.a:1|c\np.b:+2|g|@0.5']
+
+    def test_reset(self, writer, packets):
+        writer.write('a', b'-1', b'|g', reset=True)
+        writer.flush()
+
+        assert packets == [b'p.a:0|g\np.a:-1|g']
+
+    def test_written_in_place(self, writer, packets):
+        buffer = writer.buffer
+
+        writer.write('a', b'1', b'|c')
+
+        assert bytes(buffer[:writer.length]) == b'p.a:1|c'
+
+        writer.flush()
+        writer.write('b', b'1', b'|c')
+
+        assert writer.buffer is buffer
+        assert len(buffer) == 32
+
+    def test_full_buffer_flushed(self, writer, packets):
+        for _ in range(5):
+            writer.write('stat', b'1', b'|c')
+        writer.flush()
+
+        # each line is 10 bytes long, packets are shorter than 32 bytes
+        assert packets == [
+            b'p.stat:1|c\np.stat:1|c',
+            b'p.stat:1|c\np.stat:1|c',
+            b'p.stat:1|c',
+        ]
+
+    def test_same_packets_as_statsd(self, writer, packets):
+        reference = StatsClient(prefix='p', maxudpsize=32)
+        lines = [('stat', 1), ('other.stat', 10), ('x', 100), ('stat', 7)]
+
+        with patch.object(reference, '_send') as send:
+            with reference.pipeline() as pipe:
+                for stat, count in lines * 3:
+                    pipe.incr(stat, count)
+
+        for stat, count in lines * 3:
+            writer.write(stat, format_value(count), b'|c')
+        writer.flush()
+
+        sent = [data.encode('ascii') for (data,), _ in send.call_args_list]
+        assert sent == packets
+
+    def test_oversized_line(self, writer, packets):
+        writer.write('a', b'1', b'|c')
+        writer.write('long', b'1' * 40, b'|g', plus=True)
+        writer.write('long', b'-1' * 20, b'|g', reset=True)
+        writer.write('b', b'2', b'|c')
+        writer.flush()
+
+        assert packets == [
+            b'p.a:1|c',
+            b'p.long:+' + b'1' * 40 + b'|g',
+            b'p.long:0|g\np.long:' + b'-1' * 20 + b'|g',
+            b'p.b:2|c',
+        ]
+
+
+class TestBufferedStatsClient(object):
+
+    @pytest.fixture
+    def packets(self):
+        return []
+
+    @pytest.fixture
+    def client(self, packets):
+        client = BufferedStatsClient(prefix='prefix', maxudpsize=64)
+        client._sock = Mock()
+        client._sock.sendto.side_effect = (
+            lambda data, addr: packets.append(bytes(data))
+        )
+        return client
+
+    @pytest.mark.parametrize('method, args, expected', [
+        ('incr', ('stat',), b'prefix.stat:1|c'),
+        ('incr', ('stat', 2, 0.5), b'prefix.stat:2|c|@0.5'),
+        ('decr', ('stat', 3), b'prefix.stat:-3|c'),
+        ('gauge', ('stat', 12.5), b'prefix.stat:12.5|g'),
+        ('gauge', ('stat', 4, 1, True), b'prefix.stat:+4|g'),
+        ('gauge', ('stat', -4, 1, True), b'prefix.stat:-4|g'),
+        ('gauge', ('stat', -4), b'prefix.stat:0|g\nprefix.stat:-4|g'),
+        ('set', ('stat', 'user'), b'prefix.stat:user|s'),
+        ('timing', ('stat', 12), b'prefix.stat:12.000000|ms'),
+        (
+            'timing', ('stat', timedelta(seconds=1.5)),
+            b'prefix.stat:1500.000000|ms'
+        ),
+    ])
+    @patch('random.random', Mock(return_value=0.1))
+    def test_methods(self, client, packets, method, args, expected):
+        getattr(client, method)(*args)
+
+        assert packets == [expected]
+
+    @patch('random.random', Mock(return_value=0.1))
+    def test_same_output_as_statsd(self, client, packets):
+        reference = StatsClient(prefix='prefix')
+
+        with patch.object(reference, '_send') as send:
+            for each in (reference, client):
+                each.incr('stat', 2, 0.5)
+                each.gauge('stat', -1.25)
+                each.timing('stat', 3.5)
+
+        sent = [data.encode('ascii') for (data,), _ in send.call_args_list]
+        assert sent == packets
+
+    @patch('random.random', return_value=0.9)
+    @pytest.mark.parametrize('method, args', [
+        ('incr', ('stat', 1, 0.5)),
+        ('gauge', ('stat', 1, 0.5)),
+        ('set', ('stat', 1, 0.5)),
+        ('timing', ('stat', 1, 0.5)),
+    ])
+    def test_not_sampled(self, random, client, packets, method, args):
+        getattr(client, method)(*args)
+
+        assert packets == []
+
+    @patch('random.random', Mock(return_value=0.9))
+    def test_send_stat(self, client, packets):
+        client._send_stat('a', '1.000000|ms|@0.5', 1)
+        client._send_stat('b', '1|c', 0.5)
+
+        with client.pipeline() as pipe:
+            pipe._send_stat('c', '2.000000|ms', 1)
+
+        assert packets == [
+            b'prefix.a:1.000000|ms|@0.5', b'prefix.c:2.000000|ms',
+        ]
+
+    @pytest.mark.parametrize('error', [socket.error, RuntimeError])
+    def test_socket_errors_ignored(self, client, error):
+        client._sock.sendto.side_effect = error
+
+        client.incr('stat')
+
+    def test_pipeline(self, client, packets):
+        with client.pipeline() as pipe:
+            pipe.incr('a')
+            pipe.timing('b', 1)
+            with pipe.timer('c'):
+                pass
+
+            assert packets == []
+
+        assert len(packets) == 1
+        assert packets[0].startswith(b'prefix.a:1|c\nprefix.b:1.000000|ms\n')
+
+    def test_pipeline_split(self, client, packets):
+        pipe = client.pipeline()
+        for _ in range(10):
+            pipe.incr('counter')
+        pipe.send()
+
+        assert packets == [
+            b'\n'.join([b'prefix.counter:1|c'] * 3),
+            b'\n'.join([b'prefix.counter:1|c'] * 3),
+            b'\n'.join([b'prefix.counter:1|c'] * 3),
+            b'prefix.counter:1|c',
+        ]
+
+    def test_nested_pipeline(self, client, packets):
+        with client.pipeline() as pipe:
+            pipe.incr('a')
+            with pipe.pipeline() as nested:
+                nested.incr('b')
+
+            assert packets == [b'prefix.b:1|c']
+
+        assert packets == [b'prefix.b:1|c', b'prefix.a:1|c']
+
+    def test_abandoned_pipeline(self, client, packets):
+        pipe = client.pipeline()
+        pipe.incr('lost')
+
+        with client.pipeline() as other:
+            other.incr('next')
+        client.incr('single')
+
+        assert packets == [b'prefix.next:1|c', b'prefix.single:1|c']
+
+    def test_pipeline_reused_after_send(self, client, packets):
+        pipe = client.pipeline()
+        pipe.incr('a')
+        pipe.send()
+        pipe.send()
+        pipe.incr('b')
+        pipe.send()
+
+        assert packets == [b'prefix.a:1|c', b'prefix.b:1|c']
+
+    def test_writers_pooled(self, client):
+        first, second = client.pipeline(), client.pipeline()
+        first.incr('a')
+        second.incr('b')
+        writer = first._writer
+
+        assert second._writer is not writer
+
+        first.send()
+        second.send()
+        client.incr('c')
+
+        assert len(client._writers) == 2
+        assert writer in client._writers
+
+    def test_writers_pool_bounded(self, client):
+        client.max_writers = 1
+        pipes = [client.pipeline() for _ in range(3)]
+        for pipe in pipes:
+            pipe.incr('a')
+        for pipe in pipes:
+            pipe.send()
+
+        assert len(client._writers) == 1
+
+    def test_writers_pool_full(self, client, packets):
+        client.max_writers = 0
+
+        client.incr('a')
+        client.incr('b')
+
+        assert packets == [b'prefix.a:1|c', b'prefix.b:1|c']
+        assert client._writers == []
+
+
+class TestLazyClientBuffered(object):
+
+    def test_buffered_udp(self, stats_config):
+        config = dict(
+            stats_config['STATSD']['test'], host='localhost', buffered=True
+        )
+        lazy_client = LazyClient(**config)
+
+        assert isinstance(lazy_client.client, BufferedStatsClient)
+        assert lazy_client.client._maxudpsize == 1024
+        assert 'buffered' not in lazy_client.config
+
+    @patch('nameko_statsd.settings.StatsClient')
+    def test_not_buffered_by_default(self, stats_client_cls, stats_config):
+        lazy_client = LazyClient(**stats_config['STATSD']['test'])
+
+        assert lazy_client.client is stats_client_cls.return_value
+
+    @patch('nameko_statsd.settings.TCPStatsClient')
+    def test_tcp_not_buffered(self, stats_client_cls, stats_config):
+        config = dict(
+            stats_config['STATSD']['test'], buffered=True, protocol='tcp'
+        )
+        lazy_client = LazyClient(**config)
+
+        assert lazy_client.protocol is Protocols.tcp
+        assert lazy_client.client is stats_client_cls.return_value
+
+    @patch('nameko_statsd.settings.StatsClient')
+    def test_reconfigure(self, stats_client_cls, stats_config):
+        config = dict(stats_config['STATSD']['test'], host='localhost')
+        lazy_client = LazyClient(**config)
+        assert lazy_client.client is stats_client_cls.return_value
+
+        lazy_client.reconfigure(buffered=True)
+
+        assert isinstance(lazy_client.client, BufferedStatsClient)
+
+    def test_shared_by_the_clients(self, stats_config):
+        config = dict(
+            stats_config['STATSD']['test'], host='localhost', buffered=True
+        )
+        lazy_client = LazyClient(**config)
+        other = LazyClient(settings=lazy_client.settings)
+
+        assert other.client is lazy_client.client
+
+    @patch('nameko_statsd.settings.StatsClient')
+    def test_not_shared_unbuffered(self, stats_client_cls, stats_config):
+        stats_client_cls.side_effect = lambda **config: Mock()
+        lazy_client = LazyClient(**stats_config['STATSD']['test'])
+        other = LazyClient(settings=lazy_client.settings)
+
+        assert other.client is not lazy_client.client
+
+    def test_shared_after_reconfigure(self, stats_config):
+        config = dict(
+            stats_config['STATSD']['test'], host='localhost', buffered=True
+        )
+        lazy_client = LazyClient(**config)
+        before = lazy_client.client
+
+        lazy_client.reconfigure(prefix='other')
+        # created by `reconfigure`, to check the new target
+        after = lazy_client.settings._client
+
+        assert lazy_client.client is after is not before
+        assert LazyClient(settings=lazy_client.settings).client is after
+        assert after._prefix == 'other'
+
+
+class BufferedService(object):
+
+    name = 'buffered_service'
+
+    statsd = StatsD('test')
+
+    @dummy
+    def client(self):
+        return self.statsd.client
+
+
+class TestStatsDBuffered(object):
+
+    def test_client_shared_by_the_workers(
+        self, container_factory, stats_config
+    ):
+        stats_config['STATSD']['test'].update(
+            host='localhost', buffered=True
+        )
+        container = container_factory(BufferedService, stats_config)
+        container.start()
+
+        clients = []
+        for _ in range(3):
+            with entrypoint_hook(container, 'client') as client:
+                clients.append(client())
+
+        assert isinstance(clients[0], BufferedStatsClient)
+        assert clients[1] is clients[0]
+        assert clients[2] is clients[0]